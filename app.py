@@ -1,19 +1,31 @@
 #!/usr/bin/env python3
 # Sheikah AI Car Control - Backend Server
 
-from flask import Flask, request, jsonify, send_from_directory
+# Use gevent as async mode for SocketIO (must patch before any other import)
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+from gevent.pool import Pool
+from gevent.event import Event
+from flask import Flask, Response, request, jsonify, send_from_directory, abort
+from werkzeug.security import safe_join
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
 import json
 import time
 import threading
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import os
+import sys
+import stat
+import signal
+import mimetypes
+from functools import lru_cache
 from datetime import datetime
-import eventlet
-
-# Use eventlet as async mode for SocketIO
-eventlet.monkey_patch()
+import orjson
 
 # Import car control modules
 from modules.movement import MovementController
@@ -22,76 +34,214 @@ from modules.mapping import MappingController
 from modules.voice import VoiceController
 from modules.battery import BatteryMonitor
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("server.log"),
-        logging.StreamHandler()
-    ]
+class ThreadPoolQueueListener(QueueListener):
+    """
+    Queue listener that runs its handlers on a gevent threadpool worker,
+    so file and console writes never block the event loop
+    """
+    
+    def start(self):
+        self._thread = gevent.get_hub().threadpool.spawn(self._monitor)
+    
+    def stop(self):
+        if self._thread:
+            self.enqueue_sentinel()
+            self._thread.get()
+            self._thread = None
+
+# Configure logging: records are queued by the request greenlets and
+# written out by the listener. The queue is the native (unpatched) one so
+# the listener blocks its own thread rather than the hub.
+log_queue = monkey.get_original('queue', 'SimpleQueue')()
+log_listener = ThreadPoolQueueListener(
+    log_queue,
+    logging.FileHandler("server.log"),
+    logging.StreamHandler()
 )
+
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+# Replace the default handlers installed by the controller modules' basicConfig
+root_logger = logging.getLogger()
+root_logger.handlers = [queue_handler]
+root_logger.setLevel(logging.INFO)
+
+log_listener.start()
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+    """
+    JSON provider backed by orjson, used by jsonify for all API responses
+    """
+    
+    # NumPy arrays (map/battery data) and non-string dict keys are serialized natively
+    OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    
+    # Keys are emitted in insertion order; sorting only costs CPU on hot endpoints
+    sort_keys = False
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.OPTIONS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Always compact (never pretty-printed, even in debug) and written as
+        # orjson bytes directly, skipping the str decode/encode round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.OPTIONS), mimetype='application/json')
+
 # Initialize Flask app
 app = Flask(__name__, static_folder='.')
+app.json = OrjsonProvider(app)  # Use orjson for request/response JSON
 CORS(app)  # Enable CORS for all routes
 
 # Initialize SocketIO with async mode
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent')
 
 # Initialize controllers
 movement_controller = MovementController()
-camera_controller = CameraController()
+camera_controller = CameraController(
+    video_codec=os.environ.get('VIDEO_CODEC', 'jpeg'),
+    pca=movement_controller.pca if movement_controller.hw_ok else None  # Same PCA9685 drives motors and gimbal
+)
 mapping_controller = MappingController()
 voice_controller = VoiceController()
 battery_monitor = BatteryMonitor()
 
-# Global state
-car_state = {
-    "is_connected": True,
-    "battery_level": 100,
-    "is_mapping": False,
-    "is_navigating": False,
-    "current_position": {"x": 0, "y": 0, "orientation": 0},
-    "last_update": time.time()
+# Valid values for movement and camera requests
+MOVEMENT_DIRECTIONS = frozenset({'forward', 'backward', 'left', 'right', 'stop'})
+CAMERA_CONTROLS = frozenset({'pan', 'tilt'})
+
+# Mapping and navigation actions: action -> (handler(data), error message on failure)
+MAP_ACTIONS = {
+    'start': (lambda data: mapping_controller.start_mapping(), "Failed to start mapping"),
+    'stop': (lambda data: mapping_controller.stop_mapping(), "Failed to stop mapping"),
+    'save': (lambda data: mapping_controller.save_map(
+        data.get('name', f"Map_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    ), "Failed to save map"),
+    'load': (lambda data: mapping_controller.load_map(data['filename']), "Failed to load map")
+}
+NAVIGATION_ACTIONS = {
+    'start': (lambda data: mapping_controller.start_navigation(data['destination']), "Failed to start navigation"),
+    'stop': (lambda data: mapping_controller.stop_navigation(), "Failed to stop navigation")
 }
 
+# Number of video frames coalesced into one WebSocket message
+VIDEO_FRAMES_PER_BATCH = 3
+
+# Telemetry is broadcast when the position changes by at least this much,
+# and at least every TELEMETRY_KEEPALIVE seconds while the car is idle
+POSITION_EPSILON = 0.01
+TELEMETRY_KEEPALIVE = 5.0
+
+# Bounded pool of greenlets streaming video to clients
+MAX_VIDEO_STREAMS = 64
+video_pool = Pool(size=MAX_VIDEO_STREAMS)
+video_streams = {}  # Client sid -> greenlet streaming video to it
+
+# Latest base64 video frame, encoded once and shared by all video streams.
+# "ready" is replaced for every new frame and set to wake the waiting streams.
+latest_frame = {"id": 0, "data": None, "ready": Event()}  # "id" is the camera's frame counter
+video_encoder = None  # Greenlet running encode_video_frames
+
+class CarState:
+    """
+    Current state of the car, updated by the telemetry loop
+    """
+    
+    __slots__ = ("is_connected", "battery_level", "is_mapping", "is_navigating", "current_position", "last_update")
+    
+    def __init__(self):
+        self.is_connected = True
+        self.battery_level = 100
+        self.is_mapping = False
+        self.is_navigating = False
+        self.current_position = {"x": 0, "y": 0, "orientation": 0}
+        self.last_update = time.time()
+    
+    def to_dict(self):
+        """Get the state as a dict"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+def _update_status_snapshot():
+    """Serialize the /api/status response once per state update (call with car_state_lock held)"""
+    global status_snapshot
+    status_snapshot = orjson.dumps({
+        "success": True,
+        "data": car_state.to_dict()
+    }, option=OrjsonProvider.OPTIONS)
+
+# Global state
+car_state = CarState()
+car_state_lock = threading.Lock()  # Guards writes to car_state
+status_snapshot = None  # Pre-serialized /api/status response body
+_update_status_snapshot()
+
+# Static files up to this size are served from memory
+STATIC_CACHE_MAX_SIZE = 256 * 1024
+STATIC_MAX_AGE = 3600  # Browser cache lifetime for static files (seconds)
+
+@lru_cache(maxsize=64)
+def _load_static(filepath, mtime_ns):
+    """Read a static file once per modification time and cache its body and MIME type"""
+    with open(filepath, 'rb') as f:
+        body = f.read()
+    return body, mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
+
+def _static_response(path):
+    """Serve a static file, from the in-memory cache when it is small"""
+    filepath = safe_join(app.root_path, path)
+    if filepath is None:
+        abort(404)
+    
+    try:
+        file_stat = os.stat(filepath)
+    except OSError:
+        abort(404)
+    
+    # Large or non-regular files go through Flask's regular file sending
+    if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size > STATIC_CACHE_MAX_SIZE:
+        return send_from_directory('.', path, max_age=STATIC_MAX_AGE)
+    
+    body, mimetype = _load_static(filepath, file_stat.st_mtime_ns)
+    response = Response(body, mimetype=mimetype)
+    response.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}'
+    return response
+
 # Serve static files
 @app.route('/')
 def index():
-    return send_from_directory('.', 'index.html')
+    return _static_response('index.html')
 
 @app.route('/<path:path>')
 def static_files(path):
-    return send_from_directory('.', path)
+    return _static_response(path)
+
+def _body():
+    """Parse the JSON request body with orjson (empty body gives an empty dict)"""
+    body = request.get_data()
+    return (orjson.loads(body) if body else None) or {}
 
 # API endpoints
 @app.route('/api/status', methods=['GET'])
 def get_status():
     """Get the current status of the car"""
-    # Update car state
-    car_state["battery_level"] = battery_monitor.battery_level
-    car_state["is_mapping"] = mapping_controller.is_mapping
-    car_state["is_navigating"] = mapping_controller.is_navigating
-    car_state["current_position"] = mapping_controller.get_car_position()
-    car_state["last_update"] = time.time()
-    
-    return jsonify({
-        "success": True,
-        "data": car_state
-    })
+    # The response is serialized by the telemetry loop whenever car_state changes
+    return app.response_class(status_snapshot, mimetype='application/json')
 
 @app.route('/api/movement', methods=['POST'])
 def control_movement():
     """Control the car's movement"""
     try:
-        data = request.json
+        data = _body()
         direction = data.get('direction', 'stop')
         speed = data.get('speed', 0)
         
         # Validate inputs
-        if direction not in ['forward', 'backward', 'left', 'right', 'stop']:
+        if direction not in MOVEMENT_DIRECTIONS:
             return jsonify({"success": False, "error": "Invalid direction"}), 400
         
         if not 0 <= speed <= 100:
@@ -113,12 +263,12 @@ def control_movement():
 def control_camera():
     """Control the camera gimbal"""
     try:
-        data = request.json
+        data = _body()
         control = data.get('control', '')
         value = data.get('value', 0)
         
         # Validate inputs
-        if control not in ['pan', 'tilt']:
+        if control not in CAMERA_CONTROLS:
             return jsonify({"success": False, "error": "Invalid control"}), 400
         
         # Execute camera command
@@ -133,6 +283,14 @@ def control_camera():
         logger.error(f"Camera control error: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/api/video.h264', methods=['GET'])
+def get_h264_video():
+    """Stream the camera as raw H.264 (when the camera uses the H.264 codec)"""
+    if not camera_controller.h264_encoder:
+        return jsonify({"success": False, "error": "H.264 streaming not active"}), 404
+    
+    return Response(camera_controller.get_h264_stream(), mimetype='video/h264')
+
 @app.route('/api/map', methods=['GET'])
 def get_map():
     """Get the current map data"""
@@ -151,44 +309,21 @@ def get_map():
 def control_map():
     """Control mapping operations"""
     try:
-        data = request.json
+        data = _body()
         action = data.get('action', '')
         
-        if action == 'start':
-            success = mapping_controller.start_mapping()
-            if success:
-                return jsonify({"success": True})
-            else:
-                return jsonify({"success": False, "error": "Failed to start mapping"}), 500
-        
-        elif action == 'stop':
-            success = mapping_controller.stop_mapping()
-            if success:
-                return jsonify({"success": True})
-            else:
-                return jsonify({"success": False, "error": "Failed to stop mapping"}), 500
+        if action not in MAP_ACTIONS:
+            return jsonify({"success": False, "error": "Invalid action"}), 400
         
-        elif action == 'save':
-            name = data.get('name', f"Map_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
-            success = mapping_controller.save_map(name)
-            if success:
-                return jsonify({"success": True})
-            else:
-                return jsonify({"success": False, "error": "Failed to save map"}), 500
-        
-        elif action == 'load':
-            filename = data.get('filename', '')
-            if not filename:
-                return jsonify({"success": False, "error": "No filename provided"}), 400
-            
-            success = mapping_controller.load_map(filename)
-            if success:
-                return jsonify({"success": True})
-            else:
-                return jsonify({"success": False, "error": "Failed to load map"}), 500
+        if action == 'load' and not data.get('filename', ''):
+            return jsonify({"success": False, "error": "No filename provided"}), 400
         
+        # Execute the mapping action
+        handler, error = MAP_ACTIONS[action]
+        if handler(data):
+            return jsonify({"success": True})
         else:
-            return jsonify({"success": False, "error": "Invalid action"}), 400
+            return jsonify({"success": False, "error": error}), 500
     
     except Exception as e:
         logger.error(f"Map control error: {e}")
@@ -212,7 +347,7 @@ def get_available_maps():
 def name_location():
     """Name a location on the map"""
     try:
-        data = request.json
+        data = _body()
         name = data.get('name', '')
         position = data.get('position', None)
         
@@ -234,29 +369,21 @@ def name_location():
 def control_navigation():
     """Control navigation operations"""
     try:
-        data = request.json
+        data = _body()
         action = data.get('action', '')
         
-        if action == 'start':
-            destination = data.get('destination', '')
-            if not destination:
-                return jsonify({"success": False, "error": "No destination provided"}), 400
-            
-            success = mapping_controller.start_navigation(destination)
-            if success:
-                return jsonify({"success": True})
-            else:
-                return jsonify({"success": False, "error": "Failed to start navigation"}), 500
+        if action not in NAVIGATION_ACTIONS:
+            return jsonify({"success": False, "error": "Invalid action"}), 400
         
-        elif action == 'stop':
-            success = mapping_controller.stop_navigation()
-            if success:
-                return jsonify({"success": True})
-            else:
-                return jsonify({"success": False, "error": "Failed to stop navigation"}), 500
+        if action == 'start' and not data.get('destination', ''):
+            return jsonify({"success": False, "error": "No destination provided"}), 400
         
+        # Execute the navigation action
+        handler, error = NAVIGATION_ACTIONS[action]
+        if handler(data):
+            return jsonify({"success": True})
         else:
-            return jsonify({"success": False, "error": "Invalid action"}), 400
+            return jsonify({"success": False, "error": error}), 500
     
     except Exception as e:
         logger.error(f"Navigation control error: {e}")
@@ -266,7 +393,7 @@ def control_navigation():
 def process_voice():
     """Process a voice command"""
     try:
-        data = request.json
+        data = _body()
         command = data.get('command', '')
         
         if not command:
@@ -326,95 +453,154 @@ def get_battery():
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
-    logger.info(f"Client connected: {request.sid}")
-    emit('status', car_state)
+    logger.debug(f"Client connected: {request.sid}")
+    emit('status', car_state.to_dict())
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
-    logger.info(f"Client disconnected: {request.sid}")
+    logger.debug(f"Client disconnected: {request.sid}")
+    
+    # Stop the client's video stream, freeing its slot in the pool
+    stream = video_streams.pop(request.sid, None)
+    if stream:
+        stream.kill(block=False)
 
 @socketio.on('request_video_stream')
 def handle_video_request(data):
     """Handle video stream request"""
+    global video_encoder
+    
     logger.info(f"Video stream requested by {request.sid}")
     
     # Start camera streaming if not already streaming
     if not camera_controller.is_streaming:
         camera_controller.start_streaming()
     
-    # Start a thread to send video frames
-    threading.Thread(target=stream_video, args=(request.sid,), daemon=True).start()
+    # Start the shared frame encoder if it isn't running
+    if video_encoder is None or video_encoder.dead:
+        video_encoder = gevent.spawn(encode_video_frames)
+    
+    # A client only gets one stream, however often it asks
+    if request.sid in video_streams:
+        logger.debug(f"Video stream already running for {request.sid}")
+        return
+    
+    # Start a pooled greenlet to send video frames
+    if video_pool.full():
+        logger.warning(f"Video stream limit reached, rejecting {request.sid}")
+        return
+    
+    video_streams[request.sid] = video_pool.spawn(stream_video, request.sid)
+
+def encode_video_frames():
+    """Encode each camera frame once and publish it to all video streams"""
+    logger.info("Video frame encoder started")
+    
+    try:
+        while camera_controller.is_streaming:
+            # Wait for the camera to encode a frame newer than the last one published
+            frame_id, frame_base64 = camera_controller.wait_for_frame(latest_frame["id"], timeout=1.0)
+            
+            if frame_base64 and frame_id != latest_frame["id"]:
+                latest_frame["id"] = frame_id
+                latest_frame["data"] = frame_base64
+                
+                # Wake all streams waiting for this frame
+                ready, latest_frame["ready"] = latest_frame["ready"], Event()
+                ready.set()
+    
+    except Exception as e:
+        logger.error(f"Video encoding error: {e}")
+    
+    logger.info("Video frame encoder ended")
 
 def stream_video(client_id):
-    """Stream video frames to a client"""
+    """Stream video frames to a client in small batches"""
     logger.info(f"Starting video stream for {client_id}")
     
+    frames = []
+    stream = gevent.getcurrent()
+    
     try:
-        while camera_controller.is_streaming:
-            # Get the current frame
-            frame_base64 = camera_controller.get_frame_base64()
+        # Stream until the camera stops or the client disconnects
+        while camera_controller.is_streaming and video_streams.get(client_id) is stream:
+            # Wait for the encoder to publish the next frame
+            if not latest_frame["ready"].wait(timeout=1.0):
+                continue
             
-            if frame_base64:
-                # Send frame to the client
-                socketio.emit('video_frame', {
-                    'frame': frame_base64
-                }, room=client_id)
+            frames.append(latest_frame["data"])
             
-            # Sleep to maintain framerate
-            eventlet.sleep(0.033)  # ~30 FPS
+            # Send a batch of frames in a single WebSocket message
+            if len(frames) >= VIDEO_FRAMES_PER_BATCH:
+                socketio.emit('video_frames', {
+                    'frames': frames
+                }, room=client_id)
+                frames = []
     
     except Exception as e:
         logger.error(f"Video streaming error: {e}")
     
+    finally:
+        if video_streams.get(client_id) is stream:
+            del video_streams[client_id]
+    
     logger.info(f"Video stream ended for {client_id}")
 
-def update_car_position():
-    """Update car position periodically"""
-    while True:
-        try:
-            # Get current position from mapping controller
-            car_state["current_position"] = mapping_controller.get_car_position()
-            
-            # Broadcast position update to all clients
-            socketio.emit('position_update', {
-                'position': car_state["current_position"]
-            })
-            
-            # Sleep for a short time
-            eventlet.sleep(0.1)
-        
-        except Exception as e:
-            logger.error(f"Position update error: {e}")
-            eventlet.sleep(1.0)
+def _position_changed(position, last_position):
+    """Check whether the car moved noticeably since the last broadcast position"""
+    if last_position is None:
+        return True
+    
+    return any(
+        abs(position[key] - last_position[key]) >= POSITION_EPSILON
+        for key in ("x", "y", "orientation")
+    )
 
-def update_battery_status():
-    """Update battery status periodically"""
+def update_telemetry():
+    """Update car position and battery status periodically"""
+    last_position = None  # Position sent in the last broadcast
+    last_emit_time = 0.0
+    
     while True:
         try:
-            # Get current battery status
+            # Get current position and battery status
+            position = mapping_controller.get_car_position()
             battery_status = battery_monitor.get_battery_status()
-            car_state["battery_level"] = battery_status["level"]
+            now = time.time()
+            
+            # Update the shared car state served by /api/status
+            with car_state_lock:
+                car_state.current_position = position
+                car_state.battery_level = battery_status["level"]
+                car_state.is_mapping = mapping_controller.is_mapping
+                car_state.is_navigating = mapping_controller.is_navigating
+                car_state.last_update = now
+                _update_status_snapshot()
             
-            # Broadcast battery update to all clients
-            socketio.emit('battery_update', battery_status)
+            # Broadcast only when the car moved, plus a periodic keepalive
+            if _position_changed(position, last_position) or now - last_emit_time >= TELEMETRY_KEEPALIVE:
+                # Broadcast position and battery in one message to all clients
+                socketio.emit('telemetry', {
+                    'position': position,
+                    'battery': battery_status
+                })
+                
+                last_position = position
+                last_emit_time = now
             
             # Sleep for a short time
-            eventlet.sleep(5.0)
+            gevent.sleep(0.1)
         
         except Exception as e:
-            logger.error(f"Battery update error: {e}")
-            eventlet.sleep(1.0)
+            logger.error(f"Telemetry update error: {e}")
+            gevent.sleep(1.0)
 
 def start_background_tasks():
     """Start background tasks"""
-    # Start position update thread
-    position_thread = threading.Thread(target=update_car_position, daemon=True)
-    position_thread.start()
-    
-    # Start battery update thread
-    battery_thread = threading.Thread(target=update_battery_status, daemon=True)
-    battery_thread.start()
+    # Start telemetry update thread
+    telemetry_thread = threading.Thread(target=update_telemetry, daemon=True)
+    telemetry_thread.start()
 
 # Cleanup function to be called on shutdown
 def cleanup():
@@ -427,9 +613,19 @@ def cleanup():
     battery_monitor.cleanup()
     logger.info("Cleanup complete")
 
+def handle_sigterm(signum, frame):
+    """Clean up and exit when the process is asked to terminate"""
+    logger.info("Server termination requested")
+    cleanup()
+    sys.exit(0)
+
 # Register cleanup function to be called on exit
+# (controller cleanup is idempotent, so repeated calls are harmless).
+# atexit runs in reverse order, so the log listener is flushed last.
 import atexit
+atexit.register(log_listener.stop)
 atexit.register(cleanup)
+signal.signal(signal.SIGTERM, handle_sigterm)
 
 if __name__ == '__main__':
     try:
@@ -3,11 +3,12 @@
 
 import logging
 import time
-import threading
-import json
+import gevent
 import os
+import orjson
 from datetime import datetime
 import random
+import numpy as np
 from pathlib import Path
 
 # Configure logging
@@ -26,6 +27,56 @@ except ImportError:
     HARDWARE_AVAILABLE = False
     logger.warning("Battery monitoring hardware not available, running in simulation mode")
 
+# Check if Numba is available to JIT-compile the battery math
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    logger.warning("Numba not available, battery math will run in pure Python")
+    
+    def njit(*args, **kwargs):
+        """Fallback decorator that leaves the function uncompiled"""
+        def decorator(func):
+            return func
+        return decorator
+
+@njit(cache=True, fastmath=True)
+def _simulate_step(level, voltage, elapsed_time, is_charging, voltage_min, voltage_range, base_current, random_factor):
+    """
+    Advance the simulated battery state by one update
+    
+    Returns:
+        tuple: (level, voltage, current, power)
+    """
+    # Simulate current draw and power consumption
+    current = base_current * random_factor
+    power = voltage * current
+    
+    if not is_charging:
+        # 1% battery roughly every 6 minutes (10% per hour) in simulation
+        level = max(0.0, level - 0.0028 * elapsed_time)
+    else:
+        # Charging is twice as fast as discharge
+        level = min(100.0, level + 0.0056 * elapsed_time)
+    
+    # Update voltage based on battery level
+    voltage = voltage_min + (voltage_range * (level / 100.0))
+    
+    return level, voltage, current, power
+
+@njit(cache=True, fastmath=True)
+def _voltage_percentage(voltage, voltage_min, voltage_range):
+    """Convert battery voltage to percentage (0-100)"""
+    # Ensure voltage is within range
+    voltage = max(voltage_min, min(voltage_min + voltage_range, voltage))
+    
+    return ((voltage - voltage_min) / voltage_range) * 100.0
+
+# Compile at import so the first monitoring update doesn't pay the JIT cost
+_simulate_step(100.0, 12.6, 0.0, False, 9.0, 3.6, 0.5, 1.0)
+_voltage_percentage(12.6, 9.0, 3.6)
+
 class BatteryMonitor:
     """
     Monitors the battery level and power consumption
@@ -47,13 +98,28 @@ class BatteryMonitor:
         self.BATTERY_VOLTAGE_MAX = 12.6  # Maximum battery voltage (V)
         self.BATTERY_VOLTAGE_MIN = 9.0   # Minimum battery voltage (V)
         
+        # Simulation constants, precomputed once
+        self._voltage_range = self.BATTERY_VOLTAGE_MAX - self.BATTERY_VOLTAGE_MIN
+        self._base_current = 0.5  # Base current draw in Amps
+        
         # Monitoring state
         self.is_monitoring = False
-        self.monitor_thread = None
+        self.monitor_thread = None  # Greenlet running the monitoring loop
         self.last_update_time = time.time()
-        
-        # Battery history
-        self.battery_history = []
+        self._cleaned = False  # Set once cleanup has run
+        
+        # Battery history, stored column-wise in preallocated ring buffers
+        self.max_history = 1000
+        self._hist = {
+            "timestamp": np.zeros(self.max_history, dtype=np.float64),  # Epoch seconds
+            "level": np.zeros(self.max_history, dtype=np.float32),
+            "voltage": np.zeros(self.max_history, dtype=np.float32),
+            "current": np.zeros(self.max_history, dtype=np.float32),
+            "power": np.zeros(self.max_history, dtype=np.float32),
+            "is_charging": np.zeros(self.max_history, dtype=bool)
+        }
+        self._hist_idx = 0  # Next write position
+        self._hist_n = 0    # Number of valid entries
         
         # Create battery logs directory if it doesn't exist
         self.logs_dir = Path("battery_logs")
@@ -109,9 +175,8 @@ class BatteryMonitor:
         # Set monitoring state
         self.is_monitoring = True
         
-        # Start monitoring thread
-        self.monitor_thread = threading.Thread(target=self._monitoring_loop, daemon=True)
-        self.monitor_thread.start()
+        # Start monitoring greenlet on the server's event loop
+        self.monitor_thread = gevent.spawn(self._monitoring_loop)
         
         return True
     
@@ -131,33 +196,41 @@ class BatteryMonitor:
         # Set monitoring state
         self.is_monitoring = False
         
-        # Wait for monitoring thread to end
+        # End the monitoring greenlet without waiting out its sleep
         if self.monitor_thread:
-            self.monitor_thread.join(timeout=1.0)
+            self.monitor_thread.kill(timeout=1.0)
             self.monitor_thread = None
         
         return True
     
     def _monitoring_loop(self):
-        """Battery monitoring thread function"""
-        logger.info("Battery monitoring thread started")
+        """Battery monitoring greenlet function"""
+        logger.info("Battery monitoring greenlet started")
         
         while self.is_monitoring:
             try:
+                # Use one timestamp for the whole update
+                timestamp = time.time()
+                
                 # Update battery measurements
-                self._update_battery_measurements()
+                self._update_battery_measurements(timestamp)
                 
                 # Add to history
-                self._add_to_history()
+                self._add_to_history(timestamp)
                 
                 # Sleep for a short time
-                time.sleep(5.0)  # Update every 5 seconds
+                gevent.sleep(5.0)  # Update every 5 seconds
             except Exception as e:
                 logger.error(f"Error in battery monitoring: {e}")
-                time.sleep(1.0)
+                gevent.sleep(1.0)
     
-    def _update_battery_measurements(self):
-        """Update battery measurements"""
+    def _update_battery_measurements(self, timestamp):
+        """
+        Update battery measurements
+        
+        Args:
+            timestamp (float): Time of this update (epoch seconds)
+        """
         if HARDWARE_AVAILABLE:
             # In a real implementation, this would read from the INA219 sensor
             # self.voltage = self.ina219.bus_voltage + self.ina219.shunt_voltage
@@ -172,42 +245,26 @@ class BatteryMonitor:
             pass
         else:
             # In simulation mode, simulate battery discharge
-            self._simulate_battery()
+            self._simulate_battery(timestamp)
     
-    def _simulate_battery(self):
-        """Simulate battery discharge and measurements"""
-        # Calculate time since last update
-        current_time = time.time()
-        elapsed_time = current_time - self.last_update_time
-        self.last_update_time = current_time
-        
-        # Simulate current draw based on random factors
-        base_current = 0.5  # Base current draw in Amps
-        random_factor = random.uniform(0.8, 1.2)  # Random variation
-        self.current = base_current * random_factor
+    def _simulate_battery(self, timestamp):
+        """
+        Simulate battery discharge and measurements
         
-        # Simulate power consumption
-        self.power = self.voltage * self.current
+        Args:
+            timestamp (float): Time of this update (epoch seconds)
+        """
+        # Calculate time since last update
+        elapsed_time = timestamp - self.last_update_time
+        self.last_update_time = timestamp
         
-        # Calculate battery discharge
-        # 1% battery roughly every 6 minutes (10% per hour) in simulation
-        discharge_rate = 0.0028 * elapsed_time  # % per second
+        # Random variation is drawn here, outside the compiled step
+        random_factor = random.uniform(0.8, 1.2)
         
-        # Apply discharge to battery level
-        if not self.is_charging:
-            self.battery_level = max(0, self.battery_level - discharge_rate)
-            
-            # Update voltage based on battery level
-            voltage_range = self.BATTERY_VOLTAGE_MAX - self.BATTERY_VOLTAGE_MIN
-            self.voltage = self.BATTERY_VOLTAGE_MIN + (voltage_range * (self.battery_level / 100))
-        else:
-            # Simulate charging
-            charge_rate = 0.0056 * elapsed_time  # % per second (twice as fast as discharge)
-            self.battery_level = min(100, self.battery_level + charge_rate)
-            
-            # Update voltage based on battery level
-            voltage_range = self.BATTERY_VOLTAGE_MAX - self.BATTERY_VOLTAGE_MIN
-            self.voltage = self.BATTERY_VOLTAGE_MIN + (voltage_range * (self.battery_level / 100))
+        self.battery_level, self.voltage, self.current, self.power = _simulate_step(
+            float(self.battery_level), self.voltage, elapsed_time, self.is_charging,
+            self.BATTERY_VOLTAGE_MIN, self._voltage_range, self._base_current, random_factor
+        )
         
         # Randomly toggle charging state (1% chance per update)
         if random.random() < 0.01:
@@ -223,31 +280,33 @@ class BatteryMonitor:
         Returns:
             float: Battery percentage (0-100)
         """
-        # Ensure voltage is within range
-        voltage = max(self.BATTERY_VOLTAGE_MIN, min(self.BATTERY_VOLTAGE_MAX, voltage))
-        
-        # Calculate percentage
-        voltage_range = self.BATTERY_VOLTAGE_MAX - self.BATTERY_VOLTAGE_MIN
-        percentage = ((voltage - self.BATTERY_VOLTAGE_MIN) / voltage_range) * 100
-        
-        return percentage
+        return _voltage_percentage(float(voltage), self.BATTERY_VOLTAGE_MIN, self._voltage_range)
     
-    def _add_to_history(self):
-        """Add current battery state to history"""
-        # Add entry to history
-        self.battery_history.append({
-            "timestamp": datetime.now().isoformat(),
-            "level": self.battery_level,
-            "voltage": self.voltage,
-            "current": self.current,
-            "power": self.power,
-            "is_charging": self.is_charging
-        })
+    def _add_to_history(self, timestamp):
+        """
+        Add current battery state to history
         
-        # Limit history size
-        max_history = 1000
-        if len(self.battery_history) > max_history:
-            self.battery_history = self.battery_history[-max_history:]
+        Args:
+            timestamp (float): Time of the measurement (epoch seconds)
+        """
+        idx = self._hist_idx
+        hist = self._hist
+        
+        # Overwrite the oldest slot once the buffer is full
+        hist["timestamp"][idx] = timestamp
+        hist["level"][idx] = self.battery_level
+        hist["voltage"][idx] = self.voltage
+        hist["current"][idx] = self.current
+        hist["power"][idx] = self.power
+        hist["is_charging"][idx] = self.is_charging
+        
+        self._hist_idx = (idx + 1) % self.max_history
+        self._hist_n = min(self._hist_n + 1, self.max_history)
+    
+    def _history_indices(self, limit):
+        """Get the ring buffer indices of the most recent entries, oldest first"""
+        count = max(0, min(limit, self._hist_n))
+        return np.arange(self._hist_idx - count, self._hist_idx) % self.max_history
     
     def get_battery_status(self):
         """
@@ -275,7 +334,13 @@ class BatteryMonitor:
         Returns:
             list: Battery history
         """
-        return self.battery_history[-limit:]
+        indices = self._history_indices(limit)
+        
+        # Build the entry dicts only when history is requested
+        columns = {key: values[indices].tolist() for key, values in self._hist.items()}
+        columns["timestamp"] = [datetime.fromtimestamp(ts).isoformat() for ts in columns["timestamp"]]
+        
+        return [dict(zip(columns, row)) for row in zip(*columns.values())]
     
     def save_battery_history(self):
         """
@@ -284,7 +349,7 @@ class BatteryMonitor:
         Returns:
             bool: Success status
         """
-        if not self.battery_history:
+        if not self._hist_n:
             logger.warning("No battery history to save")
             return False
         
@@ -296,8 +361,8 @@ class BatteryMonitor:
         
         try:
             # Save battery history to file
-            with open(filepath, 'w') as f:
-                json.dump(self.battery_history, f, indent=2)
+            with open(filepath, 'wb') as f:
+                f.write(orjson.dumps(self.get_battery_history(self.max_history)))
             
             logger.info(f"Battery history saved successfully: {filename}")
             return True
@@ -309,33 +374,66 @@ class BatteryMonitor:
         """
         Estimate remaining battery time
         
+        Returns:
+            float: Estimated remaining time in minutes
+        """
+        return self._estimate_remaining_time(self.current)
+    
+    def estimate_remaining_time_smoothed(self, window=60):
+        """
+        Estimate remaining battery time from the average recent current draw
+        
+        Args:
+            window (int): Number of most recent history entries to average
+        
+        Returns:
+            float: Estimated remaining time in minutes
+        """
+        currents = self._hist["current"][self._history_indices(window)]
+        
+        # Fall back to the instantaneous reading until there is history
+        average_current = float(np.mean(currents)) if currents.size else self.current
+        
+        return self._estimate_remaining_time(average_current)
+    
+    def _estimate_remaining_time(self, current):
+        """
+        Estimate remaining battery time for a given current draw
+        
+        Args:
+            current (float): Current draw (A)
+        
         Returns:
             float: Estimated remaining time in minutes
         """
         if self.is_charging:
             # Estimate time to full charge
             remaining_charge = 100 - self.battery_level
-            if self.current <= 0:
+            if current <= 0:
                 return float('inf')  # Avoid division by zero
             
             # Assuming charging current is constant
-            charging_current = abs(self.current)
+            charging_current = abs(current)
             hours_to_full = (remaining_charge / 100) * self.BATTERY_CAPACITY / (charging_current * 1000)
             return hours_to_full * 60  # Convert to minutes
         else:
             # Estimate time to empty
-            if self.current <= 0:
+            if current <= 0:
                 return float('inf')  # Avoid division by zero
             
             # Calculate remaining capacity
             remaining_capacity = (self.battery_level / 100) * self.BATTERY_CAPACITY
             
             # Calculate time to empty
-            hours_to_empty = remaining_capacity / (self.current * 1000)
+            hours_to_empty = remaining_capacity / (current * 1000)
             return hours_to_empty * 60  # Convert to minutes
     
     def cleanup(self):
         """Clean up resources"""
+        if self._cleaned:
+            return
+        self._cleaned = True
+        
         logger.info("Cleaning up battery monitor resources")
         
         # Stop monitoring
@@ -6,32 +6,163 @@ import time
 import threading
 import cv2
 import numpy as np
+from gevent import monkey, get_hub
 from datetime import datetime
 import os
-import base64
 import json
+import queue
+import subprocess
+from functools import lru_cache
 
+# Use the SIMD-accelerated base64 implementation if available
 try:
-    import RPi.GPIO as GPIO
-    from adafruit_pca9685 import PCA9685
-    import board
-    import busio
-    HARDWARE_AVAILABLE = True
+    import pybase64 as base64
 except ImportError:
-    HARDWARE_AVAILABLE = False
-    logging.warning("Hardware libraries not available, running in simulation mode")
+    import base64
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _run_blocking(func, *args):
+    """
+    Run a blocking OpenCV call without stalling other threads
+    
+    OpenCV releases the GIL inside capture and encode calls, but when the app
+    has monkey-patched threading for gevent the camera threads are greenlets,
+    so the call is handed to the hub's native threadpool instead.
+    """
+    if monkey.is_module_patched('threading'):
+        return get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+@lru_cache(maxsize=64)
+def _render_text_tile(text):
+    """
+    Render white overlay text into a small alpha tile once
+    
+    Args:
+        text (str): Text to render
+    
+    Returns:
+        tuple: (alpha, anchor) where anchor is the text origin within the tile
+    """
+    font, scale, thickness = cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2
+    (width, height), baseline = cv2.getTextSize(text, font, scale, thickness)
+    
+    pad = thickness
+    tile = np.zeros((height + baseline + 2 * pad, width + 2 * pad), dtype=np.uint8)
+    anchor = (pad, pad + height)
+    cv2.putText(tile, text, anchor, font, scale, 255, thickness)
+    
+    alpha = tile.astype(np.uint16)[:, :, None]
+    return alpha, anchor
+
+class _H264Encoder:
+    """
+    Persistent H.264 encoder running as an FFmpeg subprocess
+    
+    Raw BGR frames are written to FFmpeg's stdin; the Annex-B byte stream it
+    produces is passed on to every subscribed client queue.
+    """
+    
+    def __init__(self, resolution, framerate, codec):
+        """
+        Start the encoder process
+        
+        Args:
+            resolution (tuple): Frame size (width, height)
+            framerate (int): Frames per second
+            codec (str): FFmpeg encoder name (e.g. 'h264_v4l2m2m')
+        """
+        width, height = resolution
+        self.process = subprocess.Popen([
+            'ffmpeg', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(framerate), '-i', '-',
+            '-c:v', codec, '-pix_fmt', 'yuv420p', '-b:v', '1M', '-g', str(framerate),
+            '-f', 'h264', '-'
+        ], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        
+        self.subscribers = []
+        self._lock = threading.Lock()
+        
+        # Start a thread to distribute the encoded stream
+        self._reader_thread = threading.Thread(target=self._read_output, daemon=True)
+        self._reader_thread.start()
+    
+    def encode(self, frame):
+        """Send a BGR frame to the encoder"""
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+    
+    def subscribe(self, max_chunks=64):
+        """
+        Subscribe to the encoded stream
+        
+        Returns:
+            queue.Queue: Queue receiving encoded chunks (None at end of stream)
+        """
+        chunks = queue.Queue(maxsize=max_chunks)
+        with self._lock:
+            self.subscribers.append(chunks)
+        return chunks
+    
+    def unsubscribe(self, chunks):
+        """Unsubscribe a queue returned by subscribe()"""
+        with self._lock:
+            if chunks in self.subscribers:
+                self.subscribers.remove(chunks)
+    
+    def _read_output(self):
+        """Encoder output thread function"""
+        while True:
+            chunk = self.process.stdout.read1(65536)
+            if not chunk:
+                break
+            
+            with self._lock:
+                subscribers = list(self.subscribers)
+            
+            for chunks in subscribers:
+                try:
+                    chunks.put_nowait(chunk)
+                except queue.Full:
+                    # Dropping data would corrupt the stream, so drop the slow client instead
+                    logger.warning("H.264 client is too slow, dropping it")
+                    self.unsubscribe(chunks)
+        
+        # Signal the end of the stream
+        with self._lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for chunks in subscribers:
+            try:
+                chunks.put_nowait(None)
+            except queue.Full:
+                pass
+    
+    def close(self):
+        """Stop the encoder process"""
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1.0)
+        except Exception:
+            self.process.kill()
+
 class CameraController:
     """
     Controls the camera gimbal and video streaming
     """
     
-    def __init__(self):
-        """Initialize the camera controller"""
+    # Supported streaming codecs
+    VIDEO_CODECS = ('jpeg', 'h264')
+    
+    def __init__(self, video_codec='jpeg', pca=None):
+        """
+        Initialize the camera controller
+        
+        Args:
+            video_codec (str): 'jpeg' for JPEG frames only, or 'h264' to also encode an H.264 stream
+            pca (PCA9685): Already initialized PCA9685 shared with the movement controller, if any
+        """
         logger.info("Initializing Camera Controller")
         
         # Camera settings
@@ -40,7 +171,43 @@ class CameraController:
         self.camera = None
         self.is_streaming = False
         self.stream_thread = None
-        self.frame_buffer = None
+        self.capture_thread = None
+        
+        # Double-buffered frames: the capture (or simulation) thread writes the back
+        # buffer and swaps it to the front, the stream thread encodes the front buffer
+        self._frame_buffers = [np.zeros((self.resolution[1], self.resolution[0], 3), dtype=np.uint8)
+                               for _ in range(2)]
+        self._front_index = 0
+        self._buf_lock = threading.Lock()
+        self._new_frame = threading.Event()  # Set whenever a new frame is published
+        self._cleaned = False  # Set once cleanup has run
+        
+        # Streaming codec: JPEG frames (current_frame) are always published for the
+        # WebSocket viewers, 'h264' also encodes a continuous H.264 stream with the FFmpeg
+        # encoder below (use the platform's hardware encoder, e.g. V4L2 M2M on Raspberry Pi 4)
+        if video_codec not in self.VIDEO_CODECS:
+            logger.error(f"Unknown video codec '{video_codec}', using JPEG")
+            video_codec = 'jpeg'
+        self.video_codec = video_codec
+        self.h264_encoder_name = 'h264_v4l2m2m'
+        self.h264_encoder = None
+        
+        # JPEG settings (no Huffman table optimization pass, it only costs encode time)
+        self._jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, 80, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+        
+        # GStreamer capture pipeline; the appsink only keeps the newest frame
+        # (for the Pi camera module use "libcamerasrc" in place of the v4l2src element)
+        self.gst_pipeline = (
+            f"v4l2src device=/dev/video0 ! video/x-raw,width={self.resolution[0]},height={self.resolution[1]},"
+            f"framerate={self.framerate}/1 ! videoconvert ! video/x-raw,format=BGR ! appsink drop=1 max-buffers=1"
+        )
+        
+        # Base64 of the current frame, reused until a new frame is encoded
+        self._frame_gen = 0  # Incremented for every encoded JPEG frame
+        self._frame_ready = threading.Event()  # Replaced and set for every encoded JPEG frame
+        self._b64_gen = -1
+        self._b64_cache = None
+        self._b64_lock = threading.Lock()
         
         # Gimbal settings
         self.SERVO_CHANNELS = {
@@ -53,20 +220,38 @@ class CameraController:
         # Servo pulse ranges (in microseconds)
         self.SERVO_MIN_PULSE = 1000  # 1ms pulse (0 degrees)
         self.SERVO_MAX_PULSE = 2000  # 2ms pulse (180 degrees)
+        self._gimbal_duty = None  # Last (pan, tilt) duty written to the PCA9685
+        
+        # PCA9685 counts for every whole-degree angle (index = angle + max angle)
+        self._duty_pan = self._duty_table(90)
+        self._duty_tilt = self._duty_table(45)
+        
+        # Import the hardware libraries only when a controller is created
+        try:
+            from adafruit_pca9685 import PCA9685
+            import board
+            import busio
+            self.hw_ok = True
+        except ImportError:
+            self.hw_ok = False
+            logger.warning("Hardware libraries not available, running in simulation mode")
         
-        # Initialize hardware if available
-        if HARDWARE_AVAILABLE:
+        # Initialize hardware if available (cleared if initialization fails)
+        if self.hw_ok:
             try:
-                # Initialize I2C bus and PCA9685 for servos
-                i2c = busio.I2C(board.SCL, board.SDA)
-                self.pca = PCA9685(i2c)
-                self.pca.frequency = 50  # Set PWM frequency to 50Hz
+                if pca is not None:
+                    # Share the movement controller's PCA9685 (already at 50Hz with auto-increment),
+                    # initializing it again would reset its mode and prescale
+                    self.pca = pca
+                else:
+                    # Initialize I2C bus (1 MHz Fast-mode Plus) and PCA9685 for servos
+                    # On Linux the bus clock is set by the kernel driver (dtparam=i2c_arm_baudrate)
+                    self.i2c = busio.I2C(board.SCL, board.SDA, frequency=1_000_000)
+                    self.pca = PCA9685(self.i2c)
+                    self.pca.frequency = 50  # Set PWM frequency to 50Hz (also enables register auto-increment)
                 
                 # Initialize camera
-                self.camera = cv2.VideoCapture(0)
-                self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
-                self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
-                self.camera.set(cv2.CAP_PROP_FPS, self.framerate)
+                self.camera = self._open_camera()
                 
                 # Center the gimbal
                 self.set_gimbal_angle('pan', 0)
@@ -75,62 +260,157 @@ class CameraController:
                 logger.info("Camera hardware initialized successfully")
             except Exception as e:
                 logger.error(f"Failed to initialize camera hardware: {e}")
-                HARDWARE_AVAILABLE = False
+                self.hw_ok = False
         
         # Initialize simulation camera if hardware not available
-        if not HARDWARE_AVAILABLE:
+        if not self.hw_ok:
             self._init_simulation_camera()
     
+    def _open_camera(self):
+        """
+        Open the camera, preferring the GStreamer pipeline
+        
+        Returns:
+            cv2.VideoCapture: Opened camera
+        """
+        camera = cv2.VideoCapture(self.gst_pipeline, cv2.CAP_GSTREAMER)
+        if camera.isOpened():
+            logger.info("Camera opened with GStreamer pipeline")
+            return camera
+        
+        # Fall back to the default backend
+        logger.warning("GStreamer capture not available, using default camera backend")
+        camera.release()
+        
+        camera = cv2.VideoCapture(0)
+        camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Keep only the freshest frame in the driver
+        camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+        camera.set(cv2.CAP_PROP_FPS, self.framerate)
+        return camera
+    
     def _init_simulation_camera(self):
         """Initialize a simulated camera for testing"""
         logger.info("Initializing simulation camera")
         
-        # Create a blank frame for simulation
-        self.frame_buffer = np.zeros((self.resolution[1], self.resolution[0], 3), dtype=np.uint8)
+        # Draw the static parts of the simulated frame once
+        self._sim_template = self._create_simulation_template()
         
         # Start a thread to update the simulated camera frame
         self.sim_thread = threading.Thread(target=self._update_simulation, daemon=True)
         self.sim_thread.start()
     
+    def _create_simulation_template(self):
+        """
+        Create the static background of the simulated camera frame
+        
+        Returns:
+            numpy.ndarray: Frame with the grid pattern and Sheikah eye
+        """
+        frame = np.zeros((self.resolution[1], self.resolution[0], 3), dtype=np.uint8)
+        
+        # Add grid lines
+        grid_size = 20
+        color = (0, 100, 200)  # Sheikah blue color
+        
+        # Horizontal grid lines
+        for y in range(0, self.resolution[1], grid_size):
+            cv2.line(frame, (0, y), (self.resolution[0], y), color, 1)
+        
+        # Vertical grid lines
+        for x in range(0, self.resolution[0], grid_size):
+            cv2.line(frame, (x, 0), (x, self.resolution[1]), color, 1)
+        
+        # Add Sheikah eye in the center
+        center_x, center_y = self.resolution[0] // 2, self.resolution[1] // 2
+        radius = 40
+        cv2.circle(frame, (center_x, center_y), radius, color, 2)
+        cv2.circle(frame, (center_x, center_y), radius // 3, color, 2)
+        cv2.line(frame, (center_x, center_y - radius // 3), (center_x, center_y - radius), color, 2)
+        
+        return frame
+    
     def _update_simulation(self):
         """Update the simulated camera frame"""
+        # Overlay text currently drawn in each frame buffer
+        buffer_text = [None, None]
+        
         while True:
-            # Create a simulated frame with a grid pattern
-            frame = np.zeros((self.resolution[1], self.resolution[0], 3), dtype=np.uint8)
-            
-            # Add grid lines
-            grid_size = 20
-            color = (0, 100, 200)  # Sheikah blue color
-            
-            # Horizontal grid lines
-            for y in range(0, self.resolution[1], grid_size):
-                cv2.line(frame, (0, y), (self.resolution[0], y), color, 1)
-            
-            # Vertical grid lines
-            for x in range(0, self.resolution[0], grid_size):
-                cv2.line(frame, (x, 0), (x, self.resolution[1]), color, 1)
-            
-            # Add timestamp
+            frame = self._back_buffer()
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            cv2.putText(frame, timestamp, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-            
-            # Add pan/tilt angles
             angle_text = f"Pan: {self.pan_angle}°, Tilt: {self.tilt_angle}°"
-            cv2.putText(frame, angle_text, (10, self.resolution[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
             
-            # Add Sheikah eye in the center
-            center_x, center_y = self.resolution[0] // 2, self.resolution[1] // 2
-            radius = 40
-            cv2.circle(frame, (center_x, center_y), radius, color, 2)
-            cv2.circle(frame, (center_x, center_y), radius // 3, color, 2)
-            cv2.line(frame, (center_x, center_y - radius // 3), (center_x, center_y - radius), color, 2)
+            # Only redraw the back buffer if its overlay text is out of date
+            back_index = self._front_index ^ 1
+            if buffer_text[back_index] != (timestamp, angle_text):
+                # Start from the prebuilt grid pattern
+                np.copyto(frame, self._sim_template)
+                
+                # Add timestamp and pan/tilt angles
+                self._draw_text(frame, timestamp, (10, 30))
+                self._draw_text(frame, angle_text, (10, self.resolution[1] - 10))
+                
+                buffer_text[back_index] = (timestamp, angle_text)
             
-            # Update the frame buffer
-            self.frame_buffer = frame
+            # Update the latest frame
+            self._publish_frame(frame)
             
             # Sleep to simulate framerate
             time.sleep(1 / self.framerate)
     
+    def _draw_text(self, frame, text, origin):
+        """
+        Draw overlay text from its cached tile
+        
+        Args:
+            frame (numpy.ndarray): Frame to draw on
+            text (str): Text to draw
+            origin (tuple): Bottom-left corner of the text (as for cv2.putText)
+        """
+        alpha, anchor = _render_text_tile(text)
+        x, y = origin[0] - anchor[0], origin[1] - anchor[1]
+        
+        # Blend white text over the region, clipped to the frame
+        region = frame[y:y + alpha.shape[0], x:x + alpha.shape[1]]
+        height, width = region.shape[:2]
+        region += ((255 - region) * alpha[:height, :width] // 255).astype(np.uint8)
+    
+    def _back_buffer(self):
+        """Get the frame buffer the producer thread writes the next frame into"""
+        return self._frame_buffers[self._front_index ^ 1]
+    
+    def _publish_frame(self, frame):
+        """
+        Swap the back buffer to the front
+        
+        Args:
+            frame (numpy.ndarray): The filled back buffer, or a new array replacing it
+        """
+        with self._buf_lock:
+            back_index = self._front_index ^ 1
+            self._frame_buffers[back_index] = frame
+            self._front_index = back_index
+        self._new_frame.set()
+    
+    def _capture_loop(self):
+        """Camera capture thread function"""
+        logger.info("Camera capture thread started")
+        
+        while self.is_streaming:
+            # Grab as soon as the driver has a frame, then decode it
+            if not _run_blocking(self.camera.grab):
+                logger.error("Failed to grab frame from camera")
+                time.sleep(0.1)
+                continue
+            
+            ret, frame = _run_blocking(self.camera.retrieve, self._back_buffer())
+            if not ret:
+                logger.error("Failed to read frame from camera")
+                time.sleep(0.1)
+                continue
+            
+            self._publish_frame(frame)
+    
     def set_gimbal_angle(self, control, angle):
         """
         Set the gimbal angle for pan or tilt
@@ -151,49 +431,106 @@ class CameraController:
             logger.error(f"Invalid control: {control}")
             return False
         
-        # Validate angle range
-        if control == 'pan' and not -90 <= angle <= 90:
-            logger.error(f"Pan angle out of range: {angle}")
+        # Update one axis, keeping the other at its current angle
+        if control == 'pan':
+            return self.set_gimbal_pose(angle, self.tilt_angle)
+        return self.set_gimbal_pose(self.pan_angle, angle)
+    
+    def set_gimbal_pose(self, pan, tilt):
+        """
+        Set both gimbal angles with a single servo update
+        
+        Args:
+            pan (int): Pan angle in degrees (-90 to 90)
+            tilt (int): Tilt angle in degrees (-45 to 45)
+        
+        Returns:
+            bool: Success status
+        """
+        # Validate angle ranges
+        if not -90 <= pan <= 90:
+            logger.error(f"Pan angle out of range: {pan}")
             return False
-        elif control == 'tilt' and not -45 <= angle <= 45:
-            logger.error(f"Tilt angle out of range: {angle}")
+        if not -45 <= tilt <= 45:
+            logger.error(f"Tilt angle out of range: {tilt}")
             return False
         
-        # Update current angle
-        if control == 'pan':
-            self.pan_angle = angle
-        else:
-            self.tilt_angle = angle
+        # Update current angles
+        self.pan_angle = pan
+        self.tilt_angle = tilt
         
-        # Set servo position if hardware is available
-        if HARDWARE_AVAILABLE:
+        # Set servo positions if hardware is available
+        if self.hw_ok:
             try:
-                # Convert angle to pulse width
-                # Map angle range to pulse width range:
-                # Pan: -90 to 90 degrees -> 1000 to 2000 microseconds
-                # Tilt: -45 to 45 degrees -> 1000 to 2000 microseconds
-                if control == 'pan':
-                    pulse_width = self._map_value(angle, -90, 90, self.SERVO_MIN_PULSE, self.SERVO_MAX_PULSE)
-                else:
-                    pulse_width = self._map_value(angle, -45, 45, self.SERVO_MIN_PULSE, self.SERVO_MAX_PULSE)
+                # Look up the PCA9685 counts for both angles
+                duty = (self._angle_duty(pan, self._duty_pan, 90), self._angle_duty(tilt, self._duty_tilt, 45))
                 
-                # Convert microseconds to duty cycle (0-65535)
-                # For 50Hz PWM, period is 20ms (20000us)
-                duty_cycle = int((pulse_width / 20000) * 65535)
+                # Skip the bus transaction if nothing changed
+                if duty == self._gimbal_duty:
+                    return True
                 
-                # Set PWM duty cycle
-                self.pca.channels[self.SERVO_CHANNELS[control]].duty_cycle = duty_cycle
+                self._write_gimbal_duty(*duty)
+                self._gimbal_duty = duty
                 
-                logger.debug(f"Set {control} servo to {pulse_width}us (duty cycle: {duty_cycle})")
+                logger.debug(f"Set gimbal to pan {pan}, tilt {tilt} degrees (counts: {duty})")
                 return True
             except Exception as e:
-                logger.error(f"Failed to set {control} angle: {e}")
+                logger.error(f"Failed to set gimbal pose: {e}")
+                self._gimbal_duty = None
                 return False
         else:
-            # In simulation mode, just update the angle
-            logger.info(f"Simulation: Set {control} angle to {angle} degrees")
+            # In simulation mode, just update the angles
+            logger.info(f"Simulation: Set gimbal to pan {pan}, tilt {tilt} degrees")
             return True
     
+    def _duty_table(self, max_angle):
+        """
+        Build the PCA9685 counts for whole-degree angles from -max_angle to max_angle
+        
+        Args:
+            max_angle (int): Largest angle of the servo's range
+        
+        Returns:
+            list: 12-bit counts, indexed by angle + max_angle
+        """
+        angles = np.arange(-max_angle, max_angle + 1)
+        return [self._pulse_to_duty(pulse) for pulse in
+                self._map_value(angles, -max_angle, max_angle, self.SERVO_MIN_PULSE, self.SERVO_MAX_PULSE).tolist()]
+    
+    def _angle_duty(self, angle, table, max_angle):
+        """Get the PCA9685 count for an angle, computing it for fractional angles"""
+        index = int(angle)
+        if index == angle:
+            return table[index + max_angle]
+        
+        # Map angle range to pulse width range (-max_angle to max_angle -> 1000 to 2000 microseconds)
+        return self._pulse_to_duty(self._map_value(angle, -max_angle, max_angle, self.SERVO_MIN_PULSE, self.SERVO_MAX_PULSE))
+    
+    def _pulse_to_duty(self, pulse_width):
+        """Convert a pulse width in microseconds to 12-bit PCA9685 counts"""
+        # For 50Hz PWM, period is 20ms (20000us)
+        return int((pulse_width / 20000) * 4095)
+    
+    def _write_gimbal_duty(self, pan_duty, tilt_duty):
+        """
+        Write both servo channels in one auto-increment I2C burst
+        
+        The pan and tilt servos sit on adjacent channels, so their LEDn_ON/OFF
+        registers (4 bytes each) are contiguous starting at the pan channel.
+        
+        Args:
+            pan_duty (int): Pan OFF count (0-4095)
+            tilt_duty (int): Tilt OFF count (0-4095)
+        """
+        register = 0x06 + 4 * self.SERVO_CHANNELS['pan']  # LEDn_ON_L of the pan channel
+        burst = bytes((
+            register,
+            0, 0, pan_duty & 0xFF, pan_duty >> 8,
+            0, 0, tilt_duty & 0xFF, tilt_duty >> 8,
+        ))
+        with self.pca.i2c_device as i2c:
+            i2c.write(burst)
+    
     def _map_value(self, value, in_min, in_max, out_min, out_max):
         """Map a value from one range to another"""
         return (value - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
@@ -207,6 +544,20 @@ class CameraController:
         logger.info("Starting video streaming")
         self.is_streaming = True
         
+        # Start the H.264 encoder if selected, falling back to JPEG frames only
+        if self.video_codec == 'h264':
+            try:
+                self.h264_encoder = _H264Encoder(self.resolution, self.framerate, self.h264_encoder_name)
+                logger.info(f"H.264 encoder started ({self.h264_encoder_name})")
+            except OSError as e:
+                logger.error(f"Failed to start H.264 encoder, streaming JPEG frames: {e}")
+                self.h264_encoder = None
+        
+        # Start capture thread for the camera hardware
+        if self.hw_ok and self.camera:
+            self.capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+            self.capture_thread.start()
+        
         # Start streaming thread
         self.stream_thread = threading.Thread(target=self._stream_video, daemon=True)
         self.stream_thread.start()
@@ -222,11 +573,20 @@ class CameraController:
         logger.info("Stopping video streaming")
         self.is_streaming = False
         
-        # Wait for streaming thread to end
+        # Wait for capture and streaming threads to end
+        if self.capture_thread:
+            self.capture_thread.join(timeout=1.0)
+            self.capture_thread = None
+        
         if self.stream_thread:
             self.stream_thread.join(timeout=1.0)
             self.stream_thread = None
         
+        # Stop the H.264 encoder
+        if self.h264_encoder:
+            self.h264_encoder.close()
+            self.h264_encoder = None
+        
         return True
     
     def _stream_video(self):
@@ -235,49 +595,120 @@ class CameraController:
         
         while self.is_streaming:
             try:
-                if HARDWARE_AVAILABLE and self.camera:
-                    # Read frame from camera
-                    ret, frame = self.camera.read()
-                    if not ret:
-                        logger.error("Failed to read frame from camera")
-                        time.sleep(0.1)
-                        continue
-                else:
-                    # Use simulated frame
-                    frame = self.frame_buffer.copy()
-                
-                # Process frame here if needed (e.g., add overlays, apply filters)
-                
-                # Convert frame to JPEG
-                _, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
+                # Wait for the capture thread to publish a new frame
+                if not self._new_frame.wait(timeout=0.5):
+                    continue
+                self._new_frame.clear()
                 
-                # Store the frame for retrieval by WebRTC or other methods
-                self.current_frame = jpeg.tobytes()
-                
-                # Sleep to maintain framerate
-                time.sleep(1 / self.framerate)
+                # Encode straight from the front buffer; holding the lock keeps
+                # the producer from swapping it to the back while it is in use
+                with self._buf_lock:
+                    self._encode_frame(self._frame_buffers[self._front_index])
             
             except Exception as e:
                 logger.error(f"Error in video streaming: {e}")
                 time.sleep(0.1)
     
+    def _encode_frame(self, frame):
+        """Encode a frame for the active streaming codec"""
+        # Process frame here if needed (e.g., add overlays, apply filters)
+        
+        if self.h264_encoder:
+            # Hand the frame to the H.264 encoder
+            try:
+                self.h264_encoder.encode(frame)
+            except OSError as e:
+                logger.error(f"H.264 encoder failed, streaming JPEG frames only: {e}")
+                self.h264_encoder.close()
+                self.h264_encoder = None
+        
+        # Convert frame to JPEG (WebSocket viewers need these in H.264 mode too)
+        _, jpeg = _run_blocking(cv2.imencode, '.jpg', frame, self._jpeg_params)
+        
+        # Store the frame for retrieval by WebRTC or other methods
+        # (a view of the encoded buffer, so the JPEG isn't copied again)
+        self.current_frame = memoryview(jpeg)
+        self._frame_gen += 1
+        
+        # Wake everyone waiting for this frame
+        ready, self._frame_ready = self._frame_ready, threading.Event()
+        ready.set()
+    
     def get_current_frame(self):
-        """Get the current camera frame as JPEG bytes"""
+        """Get the current camera frame as a JPEG bytes-like object"""
         if not self.is_streaming:
             logger.warning("Video streaming is not active")
             return None
         
         return self.current_frame if hasattr(self, 'current_frame') else None
     
+    def get_h264_stream(self):
+        """
+        Generate the H.264 (Annex-B) byte stream for one client
+        
+        Yields:
+            bytes: Encoded stream data
+        """
+        encoder = self.h264_encoder
+        if not encoder:
+            return
+        
+        chunks = encoder.subscribe()
+        try:
+            while self.is_streaming:
+                try:
+                    chunk = chunks.get(timeout=1.0)
+                except queue.Empty:
+                    # Stop if the encoder dropped this client
+                    if chunks not in encoder.subscribers:
+                        break
+                    continue
+                
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            encoder.unsubscribe(chunks)
+    
     def get_frame_base64(self):
         """Get the current camera frame as base64 encoded JPEG"""
-        frame = self.get_current_frame()
-        if frame:
-            return base64.b64encode(frame).decode('utf-8')
-        return None
+        return self._frame_base64()[1]
+    
+    def wait_for_frame(self, last_id, timeout=None):
+        """
+        Wait for a frame newer than the one last seen
+        
+        Args:
+            last_id (int): Id of the last frame seen (0 for none)
+            timeout (float): Seconds to wait, or None to wait indefinitely
+        
+        Returns:
+            tuple: (frame_id, base64 encoded JPEG), or (last_id, None) if no new frame arrived
+        """
+        # Take the event before checking the counter, so a frame arriving in between still wakes us
+        ready = self._frame_ready
+        if self._frame_gen == last_id and not ready.wait(timeout):
+            return last_id, None
+        
+        return self._frame_base64()
+    
+    def _frame_base64(self):
+        """Get the current frame id and base64 encoded JPEG, encoding it once per frame"""
+        with self._b64_lock:
+            # Only encode again if a new frame arrived (read the counter before the frame)
+            frame_gen = self._frame_gen
+            if frame_gen != self._b64_gen or not self.is_streaming:
+                frame = self.get_current_frame()
+                self._b64_cache = base64.b64encode(frame).decode('utf-8') if frame else None
+                self._b64_gen = frame_gen
+            return frame_gen, self._b64_cache
     
     def cleanup(self):
         """Clean up resources"""
+        if self._cleaned:
+            return
+        self._cleaned = True
+        
         logger.info("Cleaning up camera controller resources")
         
         # Stop streaming
@@ -285,7 +716,7 @@ class CameraController:
             self.stop_streaming()
         
         # Release camera
-        if HARDWARE_AVAILABLE and self.camera:
+        if self.hw_ok and self.camera:
             self.camera.release()
         
         # Center gimbal before shutdown
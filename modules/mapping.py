@@ -2,10 +2,9 @@
 # Sheikah AI Car Control - Mapping Controller Module
 
 import logging
-import time
 import threading
 import os
-import json
+import orjson
 import numpy as np
 import cv2
 from datetime import datetime
@@ -26,6 +25,44 @@ except ImportError:
     SLAM_AVAILABLE = False
     logger.warning("ORB-SLAM3 not available, running in simulation mode")
 
+# Check if Numba is available to JIT-compile the navigation math
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    logger.warning("Numba not available, navigation math will run in pure Python")
+    
+    def njit(*args, **kwargs):
+        """Fallback decorator that leaves the function uncompiled"""
+        def decorator(func):
+            return func
+        return decorator
+
+@njit(cache=True, fastmath=True)
+def _nav_step(x, y, dest_x, dest_y, step_size):
+    """
+    Move one step straight towards the destination
+    
+    Returns:
+        tuple: (x, y, orientation, distance) where distance is measured before the step
+    """
+    # Calculate distance to destination
+    dx = dest_x - x
+    dy = dest_y - y
+    distance = math.sqrt(dx * dx + dy * dy)
+    
+    # Close enough, don't move
+    if distance < 10.0:
+        return x, y, 0.0, distance
+    
+    # Turn towards the destination, then move forward
+    angle = math.atan2(dy, dx)
+    return x + step_size * math.cos(angle), y + step_size * math.sin(angle), math.degrees(angle), distance
+
+# Compile at import so navigation doesn't pay the JIT cost
+_nav_step(0.0, 0.0, 100.0, 100.0, 0.05)
+
 class MappingController:
     """
     Controls SLAM mapping and navigation functionality
@@ -44,22 +81,25 @@ class MappingController:
         self.is_navigating = False
         self.slam_thread = None
         self.navigation_thread = None
+        self._map_stop = threading.Event()  # Set to stop the mapping thread
+        self._nav_stop = threading.Event()  # Set to stop the navigation thread
+        self._cleaned = False  # Set once cleanup has run
         
-        # Current map data
+        # Current map data (points and trajectory are kept as arrays, see get_map_data)
         self.current_map = {
             "name": "",
             "created": "",
-            "points": [],
-            "trajectory": [],
             "locations": {}
         }
+        self._points = np.empty((0, 3), dtype=np.float64)  # Map points (x, y, z)
+        self._trajectory = np.empty((0, 3), dtype=np.float64)  # Trajectory (x, y, orientation)
         
-        # Car position (x, y, orientation in degrees)
-        self.car_position = {
-            "x": 0,
-            "y": 0,
-            "orientation": 0
-        }
+        # Map revealed by the mapping simulation
+        self._sim_points = self._points
+        self._sim_trajectory = self._trajectory
+        
+        # Car position (x, y, orientation in degrees), see get_car_position
+        self.car_position = np.zeros(3, dtype=np.float64)
         
         # Initialize SLAM system if available
         if SLAM_AVAILABLE:
@@ -96,48 +136,45 @@ class MappingController:
         # Create a simple rectangular room with some features
         width, height = 500, 400
         
-        # Create walls (points along the perimeter)
-        wall_points = []
-        for x in range(0, width, 10):
-            wall_points.append({"x": x, "y": 0, "z": 0})
-            wall_points.append({"x": x, "y": height, "z": 0})
-        
-        for y in range(0, height, 10):
-            wall_points.append({"x": 0, "y": y, "z": 0})
-            wall_points.append({"x": width, "y": y, "z": 0})
+        # Create walls (points along the perimeter), all points on the ground
+        xs = np.arange(0, width, 10)
+        ys = np.arange(0, height, 10)
+        wall_points = np.zeros((2 * (len(xs) + len(ys)), 3), dtype=np.float64)
+        wall_points[0:2 * len(xs):2, 0] = xs
+        wall_points[1:2 * len(xs):2, 0] = xs
+        wall_points[1:2 * len(xs):2, 1] = height
+        wall_points[2 * len(xs)::2, 1] = ys
+        wall_points[2 * len(xs) + 1::2, 0] = width
+        wall_points[2 * len(xs) + 1::2, 1] = ys
         
         # Add some random feature points inside the room
-        feature_points = []
-        for _ in range(100):
-            x = np.random.randint(10, width - 10)
-            y = np.random.randint(10, height - 10)
-            z = 0  # All points on the ground for simplicity
-            feature_points.append({"x": x, "y": y, "z": z})
+        feature_points = np.zeros((100, 3), dtype=np.float64)
+        feature_points[:, 0] = np.random.randint(10, width - 10, 100)
+        feature_points[:, 1] = np.random.randint(10, height - 10, 100)
         
         # Combine all points
-        all_points = wall_points + feature_points
-        
-        # Create a simulated trajectory
-        trajectory = []
-        for t in range(100):
-            x = width / 2 + (width / 3) * math.cos(t / 10)
-            y = height / 2 + (height / 3) * math.sin(t / 10)
-            orientation = math.degrees(math.atan2(
-                math.sin((t+1) / 10) - math.sin(t / 10),
-                math.cos((t+1) / 10) - math.cos(t / 10)
-            ))
-            trajectory.append({"x": x, "y": y, "orientation": orientation})
+        self._sim_points = np.concatenate((wall_points, feature_points))
+        self._points = self._sim_points
+        
+        # Create a simulated trajectory (an ellipse, heading along the direction of travel)
+        t = np.arange(101) / 10
+        cos_t, sin_t = np.cos(t), np.sin(t)
+        trajectory = np.empty((100, 3), dtype=np.float64)
+        trajectory[:, 0] = width / 2 + (width / 3) * cos_t[:-1]
+        trajectory[:, 1] = height / 2 + (height / 3) * sin_t[:-1]
+        trajectory[:, 2] = np.degrees(np.arctan2(np.diff(sin_t), np.diff(cos_t)))
+        
+        self._sim_trajectory = trajectory
+        self._trajectory = self._sim_trajectory
         
         # Set initial car position
-        if trajectory:
-            self.car_position = trajectory[0].copy()
+        if len(self._trajectory):
+            self.car_position[:] = self._trajectory[0]
         
         # Create simulated map
         self.current_map = {
             "name": "Simulated Map",
             "created": datetime.now().isoformat(),
-            "points": all_points,
-            "trajectory": trajectory,
             "locations": {
                 "living_room": {"x": width / 4, "y": height / 4, "name": "Living Room"},
                 "kitchen": {"x": 3 * width / 4, "y": height / 4, "name": "Kitchen"},
@@ -166,13 +203,14 @@ class MappingController:
         self.current_map = {
             "name": f"Map_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
             "created": datetime.now().isoformat(),
-            "points": [],
-            "trajectory": [],
             "locations": {}
         }
+        self._points = np.empty((0, 3), dtype=np.float64)
+        self._trajectory = np.empty((0, 3), dtype=np.float64)
         
         # Set mapping state
         self.is_mapping = True
+        self._map_stop.clear()
         
         # Start mapping thread
         self.slam_thread = threading.Thread(target=self._mapping_loop, daemon=True)
@@ -195,6 +233,7 @@ class MappingController:
         
         # Set mapping state
         self.is_mapping = False
+        self._map_stop.set()
         
         # Wait for mapping thread to end
         if self.slam_thread:
@@ -226,13 +265,10 @@ class MappingController:
         logger.info("Simulating SLAM mapping")
         
         # Simulate mapping by gradually revealing the pre-generated map
-        simulated_map = self.current_map.copy()
-        total_points = len(simulated_map["points"])
-        total_trajectory = len(simulated_map["trajectory"])
-        
-        # Clear the current map
-        self.current_map["points"] = []
-        self.current_map["trajectory"] = []
+        simulated_points = self._sim_points
+        simulated_trajectory = self._sim_trajectory
+        total_points = len(simulated_points)
+        total_trajectory = len(simulated_trajectory)
         
         # Gradually add points and trajectory
         point_step = max(1, total_points // 100)
@@ -241,22 +277,19 @@ class MappingController:
         point_index = 0
         traj_index = 0
         
-        while self.is_mapping and (point_index < total_points or traj_index < total_trajectory):
-            # Add some points
-            for _ in range(point_step):
-                if point_index < total_points:
-                    self.current_map["points"].append(simulated_map["points"][point_index])
-                    point_index += 1
+        while not self._map_stop.is_set() and (point_index < total_points or traj_index < total_trajectory):
+            # Add some points (views of the pre-generated arrays, no copying)
+            point_index = min(point_index + point_step, total_points)
+            self._points = simulated_points[:point_index]
             
             # Add trajectory point and update car position
             if traj_index < total_trajectory:
-                traj_point = simulated_map["trajectory"][traj_index]
-                self.current_map["trajectory"].append(traj_point)
-                self.car_position = traj_point.copy()
+                self.car_position[:] = simulated_trajectory[traj_index]
                 traj_index += 1
+                self._trajectory = simulated_trajectory[:traj_index]
             
-            # Sleep to simulate processing time
-            time.sleep(0.1)
+            # Wait to simulate processing time (returns early when mapping is stopped)
+            self._map_stop.wait(0.1)
     
     def save_map(self, name=None):
         """
@@ -268,7 +301,7 @@ class MappingController:
         Returns:
             bool: Success status
         """
-        if not self.current_map["points"]:
+        if not len(self._points):
             logger.warning("No map data to save")
             return False
         
@@ -283,9 +316,15 @@ class MappingController:
         logger.info(f"Saving map to {filepath}")
         
         try:
-            # Save map to file
-            with open(filepath, 'w') as f:
-                json.dump(self.current_map, f, indent=2)
+            # Save points and trajectory as newline-delimited JSON sidecar files
+            self._write_ndjson(self._sidecar_path(filepath, "points"),
+                               ({"x": x, "y": y, "z": z} for x, y, z in self._points.tolist()))
+            self._write_ndjson(self._sidecar_path(filepath, "traj"),
+                               ({"x": x, "y": y, "orientation": o} for x, y, o in self._trajectory.tolist()))
+            
+            # Save map metadata (name, created, locations) last, once the sidecars are complete
+            with open(filepath, 'wb') as f:
+                f.write(orjson.dumps(self.current_map, option=orjson.OPT_INDENT_2))
             
             logger.info(f"Map saved successfully: {filename}")
             return True
@@ -321,12 +360,27 @@ class MappingController:
         
         try:
             # Load map from file
-            with open(filepath, 'r') as f:
-                self.current_map = json.load(f)
+            with open(filepath, 'rb') as f:
+                self.current_map = orjson.loads(f.read())
+            
+            # Read points and trajectory from the sidecar files
+            # (maps saved before the sidecar format keep them in the main file)
+            points = self.current_map.pop("points", None)
+            if points is None:
+                points = self._read_ndjson(self._sidecar_path(filepath, "points"))
+            trajectory = self.current_map.pop("trajectory", None)
+            if trajectory is None:
+                trajectory = self._read_ndjson(self._sidecar_path(filepath, "traj"))
+            
+            # Keep the points and trajectory as arrays
+            self._points = np.array([(p["x"], p["y"], p.get("z", 0)) for p in points],
+                                    dtype=np.float64).reshape(-1, 3)
+            self._trajectory = np.array([(p["x"], p["y"], p["orientation"]) for p in trajectory],
+                                        dtype=np.float64).reshape(-1, 3)
             
             # Set initial car position
-            if self.current_map["trajectory"]:
-                self.car_position = self.current_map["trajectory"][0].copy()
+            if len(self._trajectory):
+                self.car_position[:] = self._trajectory[0]
             
             logger.info(f"Map loaded successfully: {filename}")
             return True
@@ -334,6 +388,20 @@ class MappingController:
             logger.error(f"Failed to load map: {e}")
             return False
     
+    def _sidecar_path(self, filepath, kind):
+        """Get the path of a map's NDJSON sidecar file (e.g. Map.points.ndjson)"""
+        return filepath.with_suffix(f".{kind}.ndjson")
+    
+    def _write_ndjson(self, filepath, rows):
+        """Write rows to a newline-delimited JSON file"""
+        with open(filepath, 'wb') as f:
+            f.writelines(orjson.dumps(row) + b"\n" for row in rows)
+    
+    def _read_ndjson(self, filepath):
+        """Read rows from a newline-delimited JSON file"""
+        with open(filepath, 'rb') as f:
+            return [orjson.loads(line) for line in f if line.strip()]
+    
     def get_available_maps(self):
         """
         Get a list of available maps
@@ -356,7 +424,9 @@ class MappingController:
         Returns:
             dict: Map data
         """
-        return self.current_map
+        points = [{"x": x, "y": y, "z": z} for x, y, z in self._points.tolist()]
+        trajectory = [{"x": x, "y": y, "orientation": o} for x, y, o in self._trajectory.tolist()]
+        return dict(self.current_map, points=points, trajectory=trajectory)
     
     def get_car_position(self):
         """
@@ -365,7 +435,8 @@ class MappingController:
         Returns:
             dict: Car position (x, y, orientation)
         """
-        return self.car_position
+        x, y, orientation = self.car_position.tolist()
+        return {"x": x, "y": y, "orientation": orientation}
     
     def name_location(self, name, position=None):
         """
@@ -378,15 +449,15 @@ class MappingController:
         Returns:
             bool: Success status
         """
-        if not self.current_map["points"]:
+        if not len(self._points):
             logger.warning("No map data available")
             return False
         
         # Use current car position if not specified
         if position is None:
             position = {
-                "x": self.car_position["x"],
-                "y": self.car_position["y"]
+                "x": float(self.car_position[0]),
+                "y": float(self.car_position[1])
             }
         
         # Create a unique key for the location
@@ -420,7 +491,7 @@ class MappingController:
             logger.warning("Navigation is already active")
             return False
         
-        if not self.current_map["points"]:
+        if not len(self._points):
             logger.warning("No map data available for navigation")
             return False
         
@@ -434,6 +505,7 @@ class MappingController:
         
         # Set navigation state
         self.is_navigating = True
+        self._nav_stop.clear()
         self.navigation_destination = self.current_map["locations"][destination_key]
         
         # Start navigation thread
@@ -457,6 +529,7 @@ class MappingController:
         
         # Set navigation state
         self.is_navigating = False
+        self._nav_stop.set()
         
         # Wait for navigation thread to end
         if self.navigation_thread:
@@ -476,12 +549,17 @@ class MappingController:
         # In a real implementation, this would use A* or other path planning algorithm
         # to find the optimal path to the destination
         
+        # Simulated movement
+        speed = 5  # units per second
+        interval = 0.01  # 100 updates per second
+        step_size = speed * interval
+        
         # For simulation, we'll just move directly towards the destination
-        while self.is_navigating:
-            # Calculate distance to destination
-            dx = dest_x - self.car_position["x"]
-            dy = dest_y - self.car_position["y"]
-            distance = math.sqrt(dx*dx + dy*dy)
+        while not self._nav_stop.is_set():
+            x, y, orientation, distance = _nav_step(
+                self.car_position[0], self.car_position[1],
+                float(dest_x), float(dest_y), step_size
+            )
             
             # If we're close enough to the destination, stop navigation
             if distance < 10:
@@ -489,27 +567,20 @@ class MappingController:
                 self.is_navigating = False
                 break
             
-            # Calculate direction to destination
-            target_orientation = math.degrees(math.atan2(dy, dx))
-            
             # Update car position (simulate movement)
-            speed = 5  # units per second
-            step_size = speed * 0.1  # for 10 updates per second
+            self.car_position[:] = (x, y, orientation)
             
-            # Update orientation first (simulate turning)
-            self.car_position["orientation"] = target_orientation
-            
-            # Then move forward
-            self.car_position["x"] += step_size * math.cos(math.radians(target_orientation))
-            self.car_position["y"] += step_size * math.sin(math.radians(target_orientation))
-            
-            # Sleep to simulate movement time
-            time.sleep(0.1)
+            # Wait to simulate movement time (returns early when navigation is stopped)
+            self._nav_stop.wait(interval)
         
         logger.info("Navigation thread ended")
     
     def cleanup(self):
         """Clean up resources"""
+        if self._cleaned:
+            return
+        self._cleaned = True
+        
         logger.info("Cleaning up mapping controller resources")
         
         # Stop mapping if active
@@ -5,25 +5,61 @@ import logging
 import time
 import threading
 import math
-try:
-    import RPi.GPIO as GPIO
-    from adafruit_pca9685 import PCA9685
-    import board
-    import busio
-    HARDWARE_AVAILABLE = True
-except ImportError:
-    HARDWARE_AVAILABLE = False
-    logging.warning("Hardware libraries not available, running in simulation mode")
+import os
+import mmap
+from functools import lru_cache
+from gevent import monkey
+from gevent.threadpool import ThreadPool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# BCM283x/BCM2711 GPIO output set/clear registers (byte offsets in /dev/gpiomem)
+GPSET0 = 0x1C
+GPCLR0 = 0x28
+
+# Linux i2c-dev ioctl selecting the slave address for plain read()/write() calls
+I2C_SLAVE = 0x0703
+
+# Native (unpatched) queue feeding the motor writer thread
+_NativeQueue = monkey.get_original('queue', 'SimpleQueue')
+
+@lru_cache(maxsize=8)
+def _motor_pwm_burst(pwm_value):
+    """
+    Build the PCA9685 auto-increment write setting motor channels 0-3 to a PWM value
+    
+    Args:
+        pwm_value (int): 12-bit OFF count (0-4095)
+    
+    Returns:
+        bytes: LED0_ON_L register address followed by LED0..LED3 ON/OFF registers
+    """
+    channel = (0, 0, pwm_value & 0xFF, (pwm_value >> 8) & 0x0F)
+    return bytes((0x06,) + channel * 4)
+
 class MovementController:
     """
     Controls the movement of the four-wheel drive car using PCA9685 and L298N
     """
     
+    # PCA9685 prescale for 50Hz PWM from the 25MHz internal oscillator
+    PCA9685_PRESCALE_50HZ = int(round(25_000_000 / (4096 * 50)) - 1)
+    
+    # What each movement does to the motors, logged in simulation mode
+    SIMULATION_MESSAGES = {
+        'forward': "All motors moving forward",
+        'backward': "All motors moving backward",
+        'left': "Motors turning left",
+        'right': "Motors turning right",
+        'stop': "All motors stopped"
+    }
+    
+    # CPU core and SCHED_FIFO priority for the motor control thread (None to leave unchanged)
+    CONTROL_CPUS = {1}
+    CONTROL_RT_PRIORITY = 80
+    
     def __init__(self):
         """Initialize the movement controller"""
         logger.info("Initializing Movement Controller")
@@ -40,14 +76,51 @@ class MovementController:
         self.current_direction = 'stop'
         self.current_speed = 0
         self.max_speed = 4095  # Max PWM value for PCA9685
+        self._cleaned = False  # Set once cleanup has run
+        
+        # PWM value for every whole speed percentage
+        self._speed_pwm = {speed: int((speed / 100) * self.max_speed) for speed in range(101)}
+        
+        # Last direction and PWM value sent to the motors
+        self._last_dir = None
+        self._last_pwm = None
+        
+        # Direction pin levels for each movement
+        self._pin_levels = self._build_pin_levels()
+        self._gpio_regs = None  # Mapped GPIO registers, if available
+        self.pca = None  # PCA9685 driving the motors (and the gimbal servos, see CameraController)
+        self._i2c_fd = None  # Raw i2c-dev file for the PCA9685, if available
+        self._motor_pool = None  # Single native thread applying queued movements to the hardware
+        self._motor_writer = None  # Result of the motor writer loop running on that thread
+        self._motor_writes = _NativeQueue()
+        
+        # Import the hardware libraries only when a controller is created
+        try:
+            import RPi.GPIO as GPIO
+            from adafruit_pca9685 import PCA9685
+            import board
+            import busio
+            self.GPIO = GPIO
+            self.hw_ok = True
+        except ImportError:
+            self.GPIO = None
+            self.hw_ok = False
+            logger.warning("Hardware libraries not available, running in simulation mode")
         
         # Initialize hardware if available
-        if HARDWARE_AVAILABLE:
+        if self.hw_ok:
             try:
                 # Initialize I2C bus and PCA9685
                 i2c = busio.I2C(board.SCL, board.SDA)
                 self.pca = PCA9685(i2c)
-                self.pca.frequency = 50  # Set PWM frequency to 50Hz
+                
+                # Set the PWM frequency to 50Hz (prescale can only be written while asleep), then
+                # wake with register auto-increment enabled (MODE1: RESTART | AI | ALLCALL) for burst writes
+                with self.pca.i2c_device as i2c:
+                    i2c.write(bytes((0x00, 0x10)))
+                    i2c.write(bytes((0xFE, self.PCA9685_PRESCALE_50HZ)))
+                    i2c.write(bytes((0x00, 0xA1)))
+                time.sleep(0.0005)  # Oscillator start-up time
                 
                 # Initialize GPIO
                 GPIO.setmode(GPIO.BCM)
@@ -55,15 +128,29 @@ class MovementController:
                     GPIO.setup(motor['in1'], GPIO.OUT)
                     GPIO.setup(motor['in2'], GPIO.OUT)
                 
+                # Write direction pins straight to the GPIO registers where possible
+                self._gpio_regs = self._open_gpio_registers()
+                
+                # Send motor PWM bursts with a single write() on the i2c-dev file
+                self._i2c_fd = self._open_i2c_device(self.pca.i2c_device.device_address)
+                self._check_i2c_clock()
+                
+                # Write to the motors from a dedicated native thread, pinned to its own core
+                # ahead of the web server, voice and video work
+                self._motor_pool = ThreadPool(1)
+                self._motor_writer = self._motor_pool.spawn(self._motor_writer_loop)
+                
                 logger.info("Hardware initialized successfully")
             except Exception as e:
-                logger.error(f"Failed to initialize hardware: {e}")
-                HARDWARE_AVAILABLE = False
+                logger.error("Failed to initialize hardware: %s", e)
+                self.hw_ok = False
         
-        # Start watchdog timer to automatically stop motors if no commands received
-        self.last_command_time = time.time()
-        self.watchdog_thread = threading.Thread(target=self._watchdog, daemon=True)
-        self.watchdog_thread.start()
+        # Watchdog timer to automatically stop motors if no commands received
+        # (armed by the first command, then re-armed lazily when it fires)
+        self.WATCHDOG_TIMEOUT = 5.0  # seconds
+        self._last_cmd_ns = time.monotonic_ns()  # Monotonic time of the last command (ns)
+        self._watchdog_timer = None
+        self._watchdog_lock = threading.Lock()  # Guards the watchdog timer and the last motor state written
     
     def move(self, direction, speed_percent):
         """
@@ -76,109 +163,283 @@ class MovementController:
         Returns:
             bool: Success status
         """
-        logger.info(f"Moving {direction} at {speed_percent}% speed")
-        
-        # Update last command time for watchdog
-        self.last_command_time = time.time()
-        
-        # Update current state
-        self.current_direction = direction
-        self.current_speed = speed_percent
-        
-        # Convert speed percentage to PWM value
-        pwm_value = int((speed_percent / 100) * self.max_speed)
-        
-        # Set motor directions and speeds based on movement direction
-        if direction == 'forward':
-            self._set_motors_forward(pwm_value)
-        elif direction == 'backward':
-            self._set_motors_backward(pwm_value)
-        elif direction == 'left':
-            self._set_motors_left(pwm_value)
-        elif direction == 'right':
-            self._set_motors_right(pwm_value)
-        elif direction == 'stop':
-            self._set_motors_stop()
-        else:
-            logger.error(f"Invalid direction: {direction}")
+        # Whole percentages only, clamped to 0-100
+        try:
+            speed_percent = max(0, min(100, int(float(speed_percent))))
+        except (TypeError, ValueError, OverflowError):
+            logger.error("Invalid speed: %s", speed_percent)
             return False
         
+        if direction not in self._pin_levels:
+            logger.error("Invalid direction: %s", direction)
+            return False
+        
+        # Hold the lock so the watchdog can't stop the motors between the checks and the write
+        with self._watchdog_lock:
+            # Update last command time for watchdog
+            self._last_cmd_ns = time.monotonic_ns()
+            if self._watchdog_timer is None:
+                self._arm_watchdog(self.WATCHDOG_TIMEOUT)
+            
+            # Repeat of the last command (e.g. teleop updates), only the watchdog needed refreshing
+            if direction == self._last_dir and speed_percent == self.current_speed and direction != 'stop':
+                return True
+            
+            logger.info("Moving %s at %s%% speed", direction, speed_percent)
+            
+            # Update current state
+            self.current_direction = direction
+            self.current_speed = speed_percent
+            
+            # Convert speed percentage to PWM value
+            pwm_value = self._speed_pwm[speed_percent]
+            
+            # The motors are already running like this, nothing to write
+            if direction == self._last_dir and pwm_value == self._last_pwm and direction != 'stop':
+                return True
+            
+            # Set motor directions and speeds based on movement direction
+            self._apply(direction, 0 if direction == 'stop' else pwm_value)
+            
+            self._last_dir = direction
+            self._last_pwm = pwm_value
         return True
     
-    def _set_motors_forward(self, pwm_value):
-        """Set all motors to move forward"""
-        if HARDWARE_AVAILABLE:
-            for motor_name, motor in self.MOTOR_PINS.items():
-                GPIO.output(motor['in1'], GPIO.HIGH)
-                GPIO.output(motor['in2'], GPIO.LOW)
-                self.pca.channels[motor['pwm']].duty_cycle = pwm_value
+    def _apply(self, direction, pwm_value):
+        """
+        Set the direction pins and motor speed for a movement
+        
+        Args:
+            direction (str): 'forward', 'backward', 'left', 'right', or 'stop'
+            pwm_value (int): 12-bit PWM value for all four motors
+        """
+        if self._motor_writer:
+            self._motor_writes.put((direction, pwm_value))
         else:
-            logger.info("Simulation: All motors moving forward")
+            logger.info("Simulation: %s", self.SIMULATION_MESSAGES[direction])
     
-    def _set_motors_backward(self, pwm_value):
-        """Set all motors to move backward"""
-        if HARDWARE_AVAILABLE:
-            for motor_name, motor in self.MOTOR_PINS.items():
-                GPIO.output(motor['in1'], GPIO.LOW)
-                GPIO.output(motor['in2'], GPIO.HIGH)
-                self.pca.channels[motor['pwm']].duty_cycle = pwm_value
-        else:
-            logger.info("Simulation: All motors moving backward")
+    def _motor_writer_loop(self):
+        """Motor writer thread function: applies queued movements to the hardware"""
+        self._pin_control_thread()
+        
+        while True:
+            command = self._motor_writes.get()
+            if command is None:
+                break
+            
+            direction, pwm_value = command
+            try:
+                self._set_direction_pins(direction)
+                self._write_motor_pwm(pwm_value)
+            except Exception as e:
+                logger.error("Failed to write motor state: %s", e)
     
-    def _set_motors_left(self, pwm_value):
-        """Set motors to turn left"""
-        if HARDWARE_AVAILABLE:
-            # Left side motors backward, right side motors forward
+    def _build_pin_levels(self):
+        """
+        Work out which direction pins are high and low for each movement
+        
+        Returns:
+            dict: direction -> (high_pins, low_pins, set_mask, clr_mask)
+        """
+        pin_levels = {}
+        for direction in ('forward', 'backward', 'left', 'right', 'stop'):
+            high_pins, low_pins = [], []
             for motor_name, motor in self.MOTOR_PINS.items():
-                if 'left' in motor_name:
-                    GPIO.output(motor['in1'], GPIO.LOW)
-                    GPIO.output(motor['in2'], GPIO.HIGH)
+                if direction == 'stop':
+                    low_pins += [motor['in1'], motor['in2']]
+                    continue
+                
+                # Turning runs the motors on the side being turned towards backward
+                if direction in ('left', 'right'):
+                    reverse = (direction == 'left') == ('left' in motor_name)
                 else:
-                    GPIO.output(motor['in1'], GPIO.HIGH)
-                    GPIO.output(motor['in2'], GPIO.LOW)
-                self.pca.channels[motor['pwm']].duty_cycle = pwm_value
+                    reverse = direction == 'backward'
+                
+                if reverse:
+                    high_pins.append(motor['in2'])
+                    low_pins.append(motor['in1'])
+                else:
+                    high_pins.append(motor['in1'])
+                    low_pins.append(motor['in2'])
+            
+            set_mask = sum(1 << pin for pin in high_pins)
+            clr_mask = sum(1 << pin for pin in low_pins)
+            pin_levels[direction] = (high_pins, low_pins, set_mask, clr_mask)
+        return pin_levels
+    
+    def _open_gpio_registers(self):
+        """
+        Map the GPIO registers of BCM283x/BCM2711 boards (Raspberry Pi 1-4)
+        
+        Returns:
+            memoryview: 32-bit view of the GPIO registers, or None if not available
+        """
+        try:
+            with open('/proc/device-tree/compatible', 'rb') as f:
+                compatible = f.read()
+            
+            # The Pi 5 (BCM2712) drives its GPIOs through the RP1 chip with a different layout
+            if b'bcm2712' in compatible or not any(chip in compatible for chip in (b'bcm2835', b'bcm2836', b'bcm2837', b'bcm2711')):
+                logger.info("GPIO register access not supported on this board, using RPi.GPIO")
+                return None
+            
+            fd = os.open('/dev/gpiomem', os.O_RDWR | os.O_SYNC)
+            try:
+                gpio_map = mmap.mmap(fd, 4096, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            finally:
+                os.close(fd)
+            
+            logger.info("Using direct GPIO register access for direction pins")
+            return memoryview(gpio_map).cast('I')
+        except OSError as e:
+            logger.warning("GPIO register access not available, using RPi.GPIO: %s", e)
+            return None
+    
+    def _open_i2c_device(self, address, bus=1):
+        """
+        Open the i2c-dev file for the PCA9685 so bursts bypass the busio lock and wrappers
+        
+        Args:
+            address (int): I2C address of the PCA9685
+            bus (int): I2C bus number
+        
+        Returns:
+            int: File descriptor addressed to the PCA9685, or None if not available
+        """
+        try:
+            import fcntl
+            fd = os.open(f'/dev/i2c-{bus}', os.O_RDWR)
+        except (ImportError, OSError) as e:
+            logger.warning("Raw I2C access not available, using busio: %s", e)
+            return None
+        
+        try:
+            fcntl.ioctl(fd, I2C_SLAVE, address)
+        except OSError as e:
+            os.close(fd)
+            logger.warning("Could not address PCA9685 at 0x%02X on /dev/i2c-%s, using busio: %s", address, bus, e)
+            return None
+        
+        logger.info("Using raw I2C writes on /dev/i2c-%s for motor PWM", bus)
+        return fd
+    
+    def _check_i2c_clock(self, bus=1, min_hz=1_000_000):
+        """
+        Warn if the I2C bus runs slower than the PCA9685's 1 MHz Fast-mode Plus
+        
+        Args:
+            bus (int): I2C bus number
+            min_hz (int): Lowest clock frequency not warned about
+        """
+        try:
+            # Device tree properties are big-endian 32-bit cells
+            with open(f'/sys/class/i2c-adapter/i2c-{bus}/of_node/clock-frequency', 'rb') as f:
+                clock_hz = int.from_bytes(f.read(4), 'big')
+        except OSError as e:
+            logger.info("Could not read I2C bus clock frequency: %s", e)
+            return
+        
+        if clock_hz < min_hz:
+            logger.warning("I2C bus %s runs at %s Hz, set dtparam=i2c_arm_baudrate=%s in /boot/config.txt for faster motor updates",
+                           bus, clock_hz, min_hz)
         else:
-            logger.info("Simulation: Motors turning left")
+            logger.info("I2C bus %s runs at %s Hz", bus, clock_hz)
     
-    def _set_motors_right(self, pwm_value):
-        """Set motors to turn right"""
-        if HARDWARE_AVAILABLE:
-            # Left side motors forward, right side motors backward
-            for motor_name, motor in self.MOTOR_PINS.items():
-                if 'left' in motor_name:
-                    GPIO.output(motor['in1'], GPIO.HIGH)
-                    GPIO.output(motor['in2'], GPIO.LOW)
-                else:
-                    GPIO.output(motor['in1'], GPIO.LOW)
-                    GPIO.output(motor['in2'], GPIO.HIGH)
-                self.pca.channels[motor['pwm']].duty_cycle = pwm_value
+    def _pin_control_thread(self):
+        """Pin the calling (motor writer) thread to CONTROL_CPUS and give it real-time priority"""
+        if self.CONTROL_CPUS:
+            try:
+                cpus = set(self.CONTROL_CPUS) & os.sched_getaffinity(0)
+                if cpus:
+                    os.sched_setaffinity(0, cpus)
+                    logger.info("Motor control pinned to CPU %s", sorted(cpus))
+            except (AttributeError, OSError) as e:
+                logger.warning("Could not set motor control CPU affinity: %s", e)
+        
+        if self.CONTROL_RT_PRIORITY:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.CONTROL_RT_PRIORITY))
+                logger.info("Motor control running with SCHED_FIFO priority %s", self.CONTROL_RT_PRIORITY)
+            except (AttributeError, OSError) as e:
+                logger.warning("Could not set real-time priority for motor control: %s", e)
+    
+    def _set_direction_pins(self, direction):
+        """Set the motor direction pins for a movement direction"""
+        high_pins, low_pins, set_mask, clr_mask = self._pin_levels[direction]
+        
+        if self._gpio_regs is not None:
+            # Set and clear all direction pins with one register write each
+            self._gpio_regs[GPSET0 // 4] = set_mask
+            self._gpio_regs[GPCLR0 // 4] = clr_mask
         else:
-            logger.info("Simulation: Motors turning right")
+            if high_pins:
+                self.GPIO.output(high_pins, self.GPIO.HIGH)
+            self.GPIO.output(low_pins, self.GPIO.LOW)
     
-    def _set_motors_stop(self):
-        """Stop all motors"""
-        if HARDWARE_AVAILABLE:
-            for motor_name, motor in self.MOTOR_PINS.items():
-                GPIO.output(motor['in1'], GPIO.LOW)
-                GPIO.output(motor['in2'], GPIO.LOW)
-                self.pca.channels[motor['pwm']].duty_cycle = 0
+    def _write_motor_pwm(self, pwm_value):
+        """Write the PWM value to all four motor channels in one I2C burst"""
+        if self._i2c_fd is not None:
+            os.write(self._i2c_fd, _motor_pwm_burst(pwm_value))
         else:
-            logger.info("Simulation: All motors stopped")
+            with self.pca.i2c_device as i2c:
+                i2c.write(_motor_pwm_burst(pwm_value))
+    
+    def _arm_watchdog(self, delay):
+        """Start the one-shot watchdog timer (call with _watchdog_lock held)"""
+        self._watchdog_timer = threading.Timer(delay, self._watchdog)
+        self._watchdog_timer.daemon = True
+        self._watchdog_timer.start()
     
     def _watchdog(self):
-        """Watchdog timer to stop motors if no commands received for 5 seconds"""
-        while True:
-            if time.time() - self.last_command_time > 5:
-                logger.warning("Watchdog triggered: No movement commands for 5 seconds")
-                self._set_motors_stop()
-            time.sleep(1)
+        """Watchdog timer to stop motors if no commands received for WATCHDOG_TIMEOUT seconds"""
+        with self._watchdog_lock:
+            idle_ns = time.monotonic_ns() - self._last_cmd_ns
+            timeout_ns = int(self.WATCHDOG_TIMEOUT * 1_000_000_000)
+            if idle_ns < timeout_ns:
+                # Commands arrived since the timer was armed, wait for the rest of the timeout
+                self._arm_watchdog((timeout_ns - idle_ns) / 1_000_000_000)
+                return
+            self._watchdog_timer = None
+            
+            # Stop while holding the lock, so a command arriving now is applied after the stop
+            logger.warning("Watchdog triggered: No movement commands for %s seconds", self.WATCHDOG_TIMEOUT)
+            self._apply('stop', 0)
+            self._last_dir = None
+            self.current_direction = 'stop'
+            self.current_speed = 0
     
     def cleanup(self):
         """Clean up GPIO and PCA9685 resources"""
+        if self._cleaned:
+            return
+        self._cleaned = True
+        
         logger.info("Cleaning up movement controller resources")
-        self._set_motors_stop()
-        if HARDWARE_AVAILABLE:
+        
+        # Stop the watchdog timer and the motors
+        with self._watchdog_lock:
+            if self._watchdog_timer:
+                self._watchdog_timer.cancel()
+                self._watchdog_timer = None
+            
+            self._apply('stop', 0)
+        
+        # Let the motor writer apply the stop, then end it
+        if self._motor_writer:
+            self._motor_writes.put(None)
+            try:
+                self._motor_writer.get(timeout=1.0)
+            except Exception as e:
+                logger.error("Motor writer did not stop cleanly: %s", e)
+            self._motor_pool.kill()
+            self._motor_pool = None
+            self._motor_writer = None
+        
+        if self._i2c_fd is not None:
+            os.close(self._i2c_fd)
+            self._i2c_fd = None
+        if self.hw_ok:
             try:
-                GPIO.cleanup()
+                self.GPIO.cleanup()
             except Exception as e:
-                logger.error(f"Error during GPIO cleanup: {e}") 
\ No newline at end of file
+                logger.error("Error during GPIO cleanup: %s", e) 
\ No newline at end of file
@@ -2,19 +2,23 @@
 # Sheikah AI Car Control - Voice Controller Module
 
 import logging
-import time
-import threading
-import json
 import os
 import re
 import random
+import orjson
+from collections import deque
 from datetime import datetime
 from pathlib import Path
+from gevent import monkey
+from gevent.threadpool import ThreadPool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Native (unpatched) sleep for the listening thread, which runs outside the gevent hub
+_native_sleep = monkey.get_original('time', 'sleep')
+
 # Check if voice recognition libraries are available
 try:
     # This would import the actual voice recognition libraries
@@ -26,28 +30,73 @@ except ImportError:
     VOICE_RECOGNITION_AVAILABLE = False
     logger.warning("Voice recognition libraries not available, running in simulation mode")
 
+# Single-word commands, matched against the words of the command
+_RE_WORD = re.compile(r'\w+')
+_GREETING_WORDS = frozenset({"hello", "hi", "hey", "greetings"})
+_STATUS_WORDS = frozenset({"status"})
+_RE_STATUS_PHRASE = re.compile(r'\bhow are you\b')
+_BATTERY_WORDS = frozenset({"battery", "power", "charge"})
+_STOP_WORDS = frozenset({"stop", "halt", "freeze"})
+
+# Multi-word command patterns, compiled once into a single alternation with one named
+# group per command type. The navigation location is captured in a lookahead so that
+# it doesn't hide other commands inside it from the scan.
+_RE_COMMAND = re.compile(
+    r'(?P<movement>\b(?:go|move|drive|turn)\s+(?P<direction>forward|backward|left|right|ahead|back)\b)'
+    r'|(?P<map_start>\b(?:start|begin|initiate)\s+(?:mapping|map|slam)\b)'
+    r'|(?P<map_stop>\b(?:stop|end|finish)\s+(?:mapping|map|slam)\b)'
+    r'|(?P<map_save>\bsave\s+(?:map|the map)\b)'
+    r'|(?P<navigation>\b(?:go|navigate|take me)\s+to\s+(?:the\s+)?(?=(?P<location>.+)))'
+)
+_RE_SPEED = re.compile(r'\b(\d+)(\s*%|\s+percent)\b')
+
+# Command types in order of precedence when a command matches several
+_COMMAND_PRIORITY = {name: index for index, name in enumerate((
+    "greeting", "status", "battery", "movement", "stop", "map_start", "map_stop", "map_save", "navigation"
+))}
+
 class VoiceController:
     """
     Controls voice recognition and interaction
     """
     
+    # CPU cores for the listening thread, kept apart from motor control (None to leave unchanged)
+    LISTEN_CPUS = {2}
+    
     def __init__(self):
         """Initialize the voice controller"""
         logger.info("Initializing Voice Controller")
         
         # Voice recognition state
         self.is_listening = False
-        self.listen_thread = None
+        self.listen_thread = None  # Result of the listening loop running on _listen_pool
+        self._listen_pool = None  # Single native thread for listening and transcription
+        self._cleaned = False  # Set once cleanup has run
         
-        # Command history
-        self.command_history = []
+        # Command history (most recent commands only, the full history is streamed to a file)
+        self.command_history = deque(maxlen=1000)
         
         # Create voice commands directory if it doesn't exist
         self.voice_dir = Path("voice_commands")
         self.voice_dir.mkdir(exist_ok=True)
         
+        # Append-only history file for this session, one JSON entry per line
+        # (opened on the first command; False once it failed to open or was closed)
+        self.history_path = self.voice_dir / f"command_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+        self._history_fp = None
+        
         # Load predefined responses
         self.responses = self._load_responses()
+        self._rng = random.Random()  # Own generator for picking responses
+        
+        # Handlers for each command type matched by _RE_COMMAND
+        self._command_handlers = {
+            "movement": self._handle_movement,
+            "map_start": self._handle_map_start,
+            "map_stop": self._handle_map_stop,
+            "map_save": self._handle_map_save,
+            "navigation": self._handle_navigation
+        }
         
         # Initialize voice recognition if available
         if VOICE_RECOGNITION_AVAILABLE:
@@ -65,7 +114,7 @@ class VoiceController:
             # self.ollama_client = ollama.Client()
             logger.info("Voice recognition system initialized")
         except Exception as e:
-            logger.error(f"Failed to initialize voice recognition: {e}")
+            logger.error("Failed to initialize voice recognition: %s", e)
             VOICE_RECOGNITION_AVAILABLE = False
             self._init_simulation()
     
@@ -74,7 +123,7 @@ class VoiceController:
         logger.info("Initializing voice recognition simulation")
     
     def _load_responses(self):
-        """Load predefined responses for common commands"""
+        """Load predefined responses for common commands (templates with parameters are functions)"""
         return {
             "greeting": [
                 "Hello! How can I assist you today?",
@@ -87,14 +136,14 @@ class VoiceController:
                 "Systems check complete. Everything is running smoothly."
             ],
             "battery": [
-                "The current battery level is {battery_level}%.",
-                "Battery is at {battery_level}%.",
-                "We have {battery_level}% battery remaining."
+                lambda battery_level: f"The current battery level is {battery_level}%.",
+                lambda battery_level: f"Battery is at {battery_level}%.",
+                lambda battery_level: f"We have {battery_level}% battery remaining."
             ],
             "movement": [
-                "Moving {direction} at {speed}% speed.",
-                "Proceeding {direction} as requested.",
-                "Navigating {direction} now."
+                lambda direction, speed: f"Moving {direction} at {speed}% speed.",
+                lambda direction, speed: f"Proceeding {direction} as requested.",
+                lambda direction, speed: f"Navigating {direction} now."
             ],
             "mapping": [
                 "Starting SLAM mapping process.",
@@ -102,9 +151,9 @@ class VoiceController:
                 "Initiating mapping sequence."
             ],
             "navigation": [
-                "Navigating to {location}.",
-                "Setting course for {location}.",
-                "Beginning journey to {location}."
+                lambda location: f"Navigating to {location}.",
+                lambda location: f"Setting course for {location}.",
+                lambda location: f"Beginning journey to {location}."
             ],
             "unknown": [
                 "I'm sorry, I didn't understand that command.",
@@ -133,13 +182,25 @@ class VoiceController:
         Returns:
             dict: Response with action and message
         """
-        logger.info(f"Processing voice command: {command}")
+        logger.info("Processing voice command: %s", command)
         
         # Add command to history
-        self.command_history.append({
+        entry = {
             "command": command,
             "timestamp": datetime.now().isoformat()
-        })
+        }
+        self.command_history.append(entry)
+        if self._history_fp is None:
+            try:
+                self._history_fp = open(self.history_path, 'ab', buffering=0)
+            except OSError as e:
+                logger.error("Failed to open command history file: %s", e)
+                self._history_fp = False
+        if self._history_fp:
+            try:
+                self._history_fp.write(orjson.dumps(entry) + b"\n")
+            except (OSError, ValueError) as e:
+                logger.error("Failed to write command history: %s", e)
         
         # Convert command to lowercase for easier matching
         command = command.lower()
@@ -148,7 +209,7 @@ class VoiceController:
         response = self._interpret_command(command)
         
         # Log response
-        logger.info(f"Command response: {response}")
+        logger.info("Command response: %s", response)
         
         return response
     
@@ -170,105 +231,26 @@ class VoiceController:
             "parameters": {}
         }
         
-        # Check for greetings
-        if re.search(r'\b(hello|hi|hey|greetings)\b', command):
-            response["message"] = self._get_random_response("greeting")
-            response["command_type"] = "greeting"
-            return response
-        
-        # Check for status request
-        if re.search(r'\b(status|how are you|system status)\b', command):
-            response["message"] = self._get_random_response("status")
-            response["command_type"] = "status"
-            return response
-        
-        # Check for battery level request
-        if re.search(r'\b(battery|power|charge)\b', command):
-            # In a real implementation, this would get the actual battery level
-            battery_level = random.randint(50, 100)
-            response["message"] = self._get_random_response("battery").format(battery_level=battery_level)
-            response["command_type"] = "battery"
-            response["parameters"]["battery_level"] = battery_level
-            return response
-        
-        # Check for movement commands
-        movement_match = re.search(r'\b(go|move|drive|turn)\s+(forward|backward|left|right|ahead|back)\b', command)
-        if movement_match:
-            direction = movement_match.group(2)
-            # Map direction synonyms
-            if direction == "ahead":
-                direction = "forward"
-            elif direction == "back":
-                direction = "backward"
-            
-            # Extract speed if specified
-            speed_match = re.search(r'\b(\d+)(\s*%|\s+percent)\b', command)
-            speed = int(speed_match.group(1)) if speed_match else 50
-            
-            response["action"] = "move"
-            response["message"] = self._get_random_response("movement").format(direction=direction, speed=speed)
-            response["command_type"] = "movement"
-            response["parameters"] = {
-                "direction": direction,
-                "speed": speed
-            }
-            return response
-        
-        # Check for stop command
-        if re.search(r'\b(stop|halt|freeze)\b', command):
-            response["action"] = "move"
-            response["message"] = "Stopping now."
-            response["command_type"] = "movement"
-            response["parameters"] = {
-                "direction": "stop",
-                "speed": 0
-            }
-            return response
-        
-        # Check for mapping commands
-        if re.search(r'\b(start|begin|initiate)\s+(mapping|map|slam)\b', command):
-            response["action"] = "map"
-            response["message"] = self._get_random_response("mapping")
-            response["command_type"] = "mapping"
-            response["parameters"] = {
-                "operation": "start"
-            }
-            return response
-        
-        if re.search(r'\b(stop|end|finish)\s+(mapping|map|slam)\b', command):
-            response["action"] = "map"
-            response["message"] = "Stopping mapping process."
-            response["command_type"] = "mapping"
-            response["parameters"] = {
-                "operation": "stop"
-            }
-            return response
-        
-        if re.search(r'\b(save)\s+(map|the map)\b', command):
-            response["action"] = "map"
-            response["message"] = "Saving the current map."
-            response["command_type"] = "mapping"
-            response["parameters"] = {
-                "operation": "save"
-            }
-            return response
-        
-        # Check for navigation commands
-        nav_match = re.search(r'\b(go|navigate|take me)\s+to\s+(?:the\s+)?(.+)', command)
-        if nav_match:
-            location = nav_match.group(2).strip()
-            
-            # Clean up location name
-            location = re.sub(r'\s+', ' ', location)
-            location = location.rstrip('.')
-            
-            response["action"] = "navigate"
-            response["message"] = self._get_random_response("navigation").format(location=location)
-            response["command_type"] = "navigation"
-            response["parameters"] = {
-                "location": location
-            }
-            return response
+        # Check single-word commands with set lookups
+        words = set(_RE_WORD.findall(command))
+        if words & _GREETING_WORDS:
+            return self._handle_greeting(None, command, response)
+        
+        if words & _STATUS_WORDS or _RE_STATUS_PHRASE.search(command):
+            return self._handle_status(None, command, response)
+        
+        if words & _BATTERY_WORDS:
+            return self._handle_battery(None, command, response)
+        
+        # Find every multi-word command in one scan and take the one with the highest precedence
+        match = min(_RE_COMMAND.finditer(command), key=lambda m: _COMMAND_PRIORITY[m.lastgroup], default=None)
+        
+        # Stop takes precedence over everything except movement
+        if words & _STOP_WORDS and (match is None or _COMMAND_PRIORITY[match.lastgroup] > _COMMAND_PRIORITY["stop"]):
+            return self._handle_stop(None, command, response)
+        
+        if match:
+            return self._command_handlers[match.lastgroup](match, command, response)
         
         # If no specific command was recognized, use LLM for more complex queries
         if VOICE_RECOGNITION_AVAILABLE:
@@ -283,11 +265,107 @@ class VoiceController:
         
         return response
     
+    def _handle_greeting(self, match, command, response):
+        """Respond to a greeting"""
+        response["message"] = self._get_random_response("greeting")
+        response["command_type"] = "greeting"
+        return response
+    
+    def _handle_status(self, match, command, response):
+        """Respond to a status request"""
+        response["message"] = self._get_random_response("status")
+        response["command_type"] = "status"
+        return response
+    
+    def _handle_battery(self, match, command, response):
+        """Respond to a battery level request"""
+        # In a real implementation, this would get the actual battery level
+        battery_level = self._rng.randrange(50, 101)
+        response["message"] = self._get_random_response("battery")(battery_level)
+        response["command_type"] = "battery"
+        response["parameters"]["battery_level"] = battery_level
+        return response
+    
+    def _handle_movement(self, match, command, response):
+        """Handle a movement command"""
+        direction = match.group("direction")
+        # Map direction synonyms
+        if direction == "ahead":
+            direction = "forward"
+        elif direction == "back":
+            direction = "backward"
+        
+        # Extract speed if specified
+        speed_match = _RE_SPEED.search(command)
+        speed = int(speed_match.group(1)) if speed_match else 50
+        
+        response["action"] = "move"
+        response["message"] = self._get_random_response("movement")(direction, speed)
+        response["command_type"] = "movement"
+        response["parameters"] = {
+            "direction": direction,
+            "speed": speed
+        }
+        return response
+    
+    def _handle_stop(self, match, command, response):
+        """Handle a stop command"""
+        response["action"] = "move"
+        response["message"] = "Stopping now."
+        response["command_type"] = "movement"
+        response["parameters"] = {
+            "direction": "stop",
+            "speed": 0
+        }
+        return response
+    
+    def _handle_map_start(self, match, command, response):
+        """Handle a start mapping command"""
+        response["action"] = "map"
+        response["message"] = self._get_random_response("mapping")
+        response["command_type"] = "mapping"
+        response["parameters"] = {
+            "operation": "start"
+        }
+        return response
+    
+    def _handle_map_stop(self, match, command, response):
+        """Handle a stop mapping command"""
+        response["action"] = "map"
+        response["message"] = "Stopping mapping process."
+        response["command_type"] = "mapping"
+        response["parameters"] = {
+            "operation": "stop"
+        }
+        return response
+    
+    def _handle_map_save(self, match, command, response):
+        """Handle a save map command"""
+        response["action"] = "map"
+        response["message"] = "Saving the current map."
+        response["command_type"] = "mapping"
+        response["parameters"] = {
+            "operation": "save"
+        }
+        return response
+    
+    def _handle_navigation(self, match, command, response):
+        """Handle a navigation command"""
+        # Clean up location name (collapse whitespace, drop trailing periods)
+        location = ' '.join(match.group("location").split()).rstrip('.')
+        
+        response["action"] = "navigate"
+        response["message"] = self._get_random_response("navigation")(location)
+        response["command_type"] = "navigation"
+        response["parameters"] = {
+            "location": location
+        }
+        return response
+    
     def _get_random_response(self, response_type):
         """Get a random response from the predefined responses"""
-        if response_type in self.responses:
-            return random.choice(self.responses[response_type])
-        return random.choice(self.responses["unknown"])
+        responses = self.responses.get(response_type) or self.responses["unknown"]
+        return responses[self._rng.randrange(len(responses))]
     
     def start_listening(self):
         """
@@ -305,9 +383,10 @@ class VoiceController:
         # Set listening state
         self.is_listening = True
         
-        # Start listening thread
-        self.listen_thread = threading.Thread(target=self._listening_loop, daemon=True)
-        self.listen_thread.start()
+        # Start listening on its own native thread
+        if self._listen_pool is None:
+            self._listen_pool = ThreadPool(1)
+        self.listen_thread = self._listen_pool.spawn(self._listening_loop)
         
         return True
     
@@ -329,7 +408,7 @@ class VoiceController:
         
         # Wait for listening thread to end
         if self.listen_thread:
-            self.listen_thread.join(timeout=1.0)
+            self.listen_thread.wait(timeout=1.0)
             self.listen_thread = None
         
         return True
@@ -338,6 +417,9 @@ class VoiceController:
         """Voice recognition thread function"""
         logger.info("Voice recognition thread started")
         
+        # Keep transcription work off the motor control core
+        self._pin_listening_thread()
+        
         if VOICE_RECOGNITION_AVAILABLE:
             # In a real implementation, this would continuously listen for voice commands
             # using the microphone and Whisper for transcription
@@ -345,7 +427,20 @@ class VoiceController:
         else:
             # In simulation mode, we'll just sleep
             while self.is_listening:
-                time.sleep(1.0)
+                _native_sleep(1.0)
+    
+    def _pin_listening_thread(self):
+        """Pin the calling (listening) thread to LISTEN_CPUS"""
+        if not self.LISTEN_CPUS:
+            return
+        
+        try:
+            cpus = set(self.LISTEN_CPUS) & os.sched_getaffinity(0)
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+                logger.info("Voice recognition pinned to CPU %s", sorted(cpus))
+        except (AttributeError, OSError) as e:
+            logger.warning("Could not set voice recognition CPU affinity: %s", e)
     
     def transcribe_audio(self, audio_data):
         """
@@ -371,45 +466,49 @@ class VoiceController:
         Get the command history
         
         Returns:
-            list: List of command history entries
+            list: List of the most recent command history entries
         """
-        return self.command_history
+        return list(self.command_history)
     
     def save_command_history(self):
         """
-        Save the command history to a file
+        Flush the command history file to disk
         
         Returns:
             bool: Success status
         """
-        if not self.command_history:
+        if not self._history_fp:
             logger.warning("No command history to save")
             return False
         
-        # Generate filename with timestamp
-        filename = f"command_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        filepath = self.voice_dir / filename
-        
-        logger.info(f"Saving command history to {filepath}")
-        
         try:
-            # Save command history to file
-            with open(filepath, 'w') as f:
-                json.dump(self.command_history, f, indent=2)
+            # Entries are written as they arrive, just make sure they reach the disk
+            self._history_fp.flush()
+            os.fsync(self._history_fp.fileno())
             
-            logger.info(f"Command history saved successfully: {filename}")
+            logger.info("Command history saved successfully: %s", self.history_path.name)
             return True
         except Exception as e:
-            logger.error(f"Failed to save command history: {e}")
+            logger.error("Failed to save command history: %s", e)
             return False
     
     def cleanup(self):
         """Clean up resources"""
+        if self._cleaned:
+            return
+        self._cleaned = True
+        
         logger.info("Cleaning up voice controller resources")
         
         # Stop listening if active
         if self.is_listening:
             self.stop_listening()
-        
-        # Save command history
-        self.save_command_history() 
\ No newline at end of file
+        if self._listen_pool:
+            self._listen_pool.kill()
+            self._listen_pool = None
+        
+        # Save and close command history
+        self.save_command_history()
+        if self._history_fp:
+            self._history_fp.close()
+        self._history_fp = False 
\ No newline at end of file